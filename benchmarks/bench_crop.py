@@ -0,0 +1,71 @@
+"""Micro-benchmark: bounding box crop of the particle tile against the old
+row/column scanning crop of the full frame.
+
+Run from the repository root: python benchmarks/bench_crop.py
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from particle_simulation.crop import crop_nonzero
+
+
+def scan_crop(img, center_x, center_y):
+    # crop_center as it was in MainWindow, walking outward row by row
+    h, w = img.shape
+    xmin = xmax = center_x
+    ymin = ymax = center_y
+
+    while img[ymin, center_x] != 0 or np.sum(img[ymin, :]) != 0:
+        if ymin <= 0:
+            break
+        ymin -= 1
+    while img[ymax, center_x] != 0 or np.sum(img[ymax, :]) != 0:
+        if ymax >= h - 1:
+            break
+        ymax += 1
+    while img[center_y, xmin] != 0 or np.sum(img[:, xmin]) != 0:
+        if xmin <= 0:
+            break
+        xmin -= 1
+    while img[center_y, xmax] == 1 or np.sum(img[:, xmax]) != 0:
+        if xmax >= w - 1:
+            break
+        xmax += 1
+
+    return(img[ymin+1:ymax, xmin+1:xmax])
+
+
+def frame(size, radius):
+    # one disk of the given radius in the middle of a size x size frame
+    img = np.zeros([size, size])
+    yy, xx = np.ogrid[:size, :size]
+    img[(yy - size//2)**2 + (xx - size//2)**2 <= radius**2] = 1
+    return img
+
+
+def main(sizes=(512, 1024, 2048, 4096), radius=20, repeat=5):
+    # the old generator scanned the full frame, the new one crops the tile
+    # the particle was drawn on (two radii around the center plus a border)
+    print('%8s %16s %16s %16s %8s' % ('frame', 'scan frame (ms)', 'scan tile (ms)',
+        'bbox tile (ms)', 'speedup'))
+    for size in sizes:
+        img = frame(size, radius)
+        c = size//2
+        half = 2*radius + 3
+        tile = img[c - half:c + half, c - half:c + half]
+        assert (scan_crop(img, c, c) == crop_nonzero(tile)).all()
+
+        scan = min(timeit.repeat(lambda: scan_crop(img, c, c), number=1, repeat=repeat))
+        scan_tile = min(timeit.repeat(lambda: scan_crop(tile, half, half), number=1, repeat=repeat))
+        bbox = min(timeit.repeat(lambda: crop_nonzero(tile), number=1, repeat=repeat))
+        print('%8d %16.3f %16.3f %16.3f %7.1fx' % (size, scan*1000, scan_tile*1000,
+            bbox*1000, scan/bbox))
+
+
+if __name__ == '__main__':
+    main()
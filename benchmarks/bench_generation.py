@@ -0,0 +1,267 @@
+"""Benchmark suite: particle placement, morphology and full-frame generation
+over a grid of image sizes, particle counts, particle sizes and placement
+rules, with fixed seeds.
+
+Run from the repository root:
+    python benchmarks/bench_generation.py [--quick] [--json out.json]
+    python benchmarks/bench_generation.py --compare baseline.json
+
+--compare reruns the suite and flags the cases slower than the baseline
+by more than --threshold.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from particle_simulation.engine import ParticleGenerator
+from particle_simulation import morphology
+from particle_simulation.morphology import KERNELS
+from particle_simulation.templates import TEMPLATES
+
+SEED = 0
+
+RULES = {
+    'free': {'not_edge': False, 'not_attach': False},
+    'not_edge': {'not_edge': True, 'not_attach': False},
+    'not_attach': {'not_edge': False, 'not_attach': True},
+    'both': {'not_edge': True, 'not_attach': True},
+}
+
+# noiseless: one run of identical particles, placed in vectorised batches;
+# mixed: half of them noisy, placed one by one by draw_particle
+SPECS = ['noiseless', 'mixed']
+
+# full-frame generation: frame size x particle count x rules x specs
+FRAME_GRID = {
+    'frame': [500, 1000, 2000],
+    'count': [50, 200, 800],
+    'rules': list(RULES),
+    'specs': SPECS,
+}
+
+# particle size and noise at a fixed frame and count
+PARTICLE_GRID = {
+    'size': [5, 15, 30],
+    'noise': [0.0, 0.2],
+}
+
+# slowdowns smaller than this many seconds are timer noise, not regressions
+MIN_DELTA = 5e-5
+
+QUICK_FRAME_GRID = {'frame': [500, 1000], 'count': [50, 200], 'rules': ['free', 'both'],
+    'specs': SPECS}
+QUICK_PARTICLE_GRID = {'size': [5, 15], 'noise': [0.0, 0.2]}
+
+
+def grid(axes):
+    names = list(axes)
+    for values in itertools.product(*[axes[name] for name in names]):
+        yield dict(zip(names, values))
+
+
+def frame_config(frame, count, rules, size=8, noise=0.0, shape='Octagon', specs='noiseless'):
+    particles = [{'shape': shape, 'size': size, 'noise': noise, 'amount': count}]
+    if specs == 'mixed':
+        particles = [{'shape': shape, 'size': size, 'noise': noise, 'amount': count//2},
+            {'shape': shape, 'size': size, 'noise': 0.2, 'amount': count - count//2}]
+    config = {'width': frame, 'height': frame, 'particles': particles,
+        'background': 0.3, 'contrast': 0.5, 'shadow': 0.2, 'gaussian': 1.0}
+    config.update(RULES[rules])
+    return config
+
+
+def cold():
+    # every case starts without cached templates or kernels
+    TEMPLATES.clear()
+    KERNELS.clear()
+
+
+def peak_memory(function):
+    # peak traced allocation of one call, in MB
+    cold()
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak/2**20
+
+
+def run_generation(config, repeat):
+    # best time of repeat images, cold caches for every image
+    times = []
+    for i in range(repeat):
+        cold()
+        generator = ParticleGenerator(config, seed=SEED)
+        start = time.perf_counter()
+        generator.generate_images()
+        times.append(time.perf_counter() - start)
+    count = len(generator.particles)
+    return {'image_s': min(times), 'particle_ms': min(times)/max(count, 1)*1000,
+        'retries': generator.retries,
+        'peak_mb': peak_memory(lambda: ParticleGenerator(config, seed=SEED).generate_images())}
+
+
+def time_calls(function, number, repeat):
+    # best time of one call, in ms
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(number):
+            function()
+        t = (time.perf_counter() - start)/number
+        best = t if best is None else min(best, t)
+    return best*1000
+
+
+def stage_cases(size, repeat):
+    # the generator's building blocks on one particle of the given size
+    generator = ParticleGenerator(frame_config(500, 0, 'both'), seed=SEED)
+    particle = generator.new_particle('Octagon', size, 0.0, 30)
+    noisy = generator.new_particle('Octagon', size, 0.2, 30)
+    tile = np.zeros([6*size, 6*size], dtype=bool)
+    tile[size:5*size, size:5*size] = True
+    frame = np.zeros([500, 500], dtype=bool)
+    frame[::50, ::50] = True
+    number = 20
+
+    def draw(p):
+        img = np.zeros([500, 500], dtype=bool)
+        generator.occupancy = None
+        generator.draw_particle(p, img)
+
+    def load():
+        img = np.zeros([500, 500], dtype=bool)
+        generator.occupancy = None
+        generator.load_particle(particle, img)
+
+    def noise_run():
+        # one vectorised call for a run of noisy particles, per particle
+        run = [dict(noisy) for i in range(64)]
+        generator.synthesise_noise(run)
+
+    draw(particle)
+    return {
+        'rotate_particle': time_calls(lambda: generator.rotate_particle(
+            particle['polygon']['rr'], particle['polygon']['cc'], 30), number, repeat),
+        'draw_particle': time_calls(lambda: draw(particle), number, repeat),
+        'draw_particle_noise': time_calls(lambda: draw(noisy), number, repeat),
+        'load_particle': time_calls(load, number, repeat),
+        'noise_run': time_calls(noise_run, 1, repeat)/64,
+        'closing': time_calls(lambda: generator.closing(tile, size=size), number, repeat),
+        'dilate_shadow': time_calls(lambda: generator.dilate(frame, 20), 3, repeat),
+        'ring_shadow': time_calls(lambda: morphology.ring(frame, 20), 3, repeat),
+    }
+
+
+def run_suite(quick=False, repeat=3, log=sys.stderr):
+    frame_grid = QUICK_FRAME_GRID if quick else FRAME_GRID
+    particle_grid = QUICK_PARTICLE_GRID if quick else PARTICLE_GRID
+    results = {'frames': [], 'particles': [], 'stages': []}
+
+    for case in grid(frame_grid):
+        result = dict(case, **run_generation(frame_config(**case), repeat))
+        results['frames'].append(result)
+        log.write('.')
+    for case in grid(particle_grid):
+        config = frame_config(1000, 200, 'both', size=case['size'], noise=case['noise'])
+        results['particles'].append(dict(case, **run_generation(config, repeat)))
+        log.write('.')
+    for size in particle_grid['size']:
+        results['stages'].append(dict(size=size, **stage_cases(size, repeat)))
+        log.write('.')
+    log.write('\n')
+    return results
+
+
+def print_results(results):
+    print('%6s %6s %11s %10s %10s %12s %8s %8s' % ('frame', 'count', 'rules', 'specs',
+        'image (s)', 'particle (ms)', 'retries', 'peak MB'))
+    for r in results['frames']:
+        print('%6d %6d %11s %10s %10.3f %12.3f %8d %8.1f' % (r['frame'], r['count'], r['rules'],
+            r.get('specs', 'noiseless'), r['image_s'], r['particle_ms'], r['retries'], r['peak_mb']))
+
+    print('\n1000x1000 frame, 200 particles, both rules')
+    print('%6s %6s %10s %12s %8s %8s' % ('size', 'noise', 'image (s)', 'particle (ms)',
+        'retries', 'peak MB'))
+    for r in results['particles']:
+        print('%6d %6.1f %10.3f %12.3f %8d %8.1f' % (r['size'], r['noise'], r['image_s'],
+            r['particle_ms'], r['retries'], r['peak_mb']))
+
+    print('\nstages, ms per call')
+    names = [name for name in results['stages'][0] if name != 'size']
+    print('%6s ' % 'size' + ' '.join('%19s' % name for name in names))
+    for r in results['stages']:
+        print('%6d ' % r['size'] + ' '.join('%19.3f' % r[name] for name in names))
+
+
+def case_times(results):
+    # {case name: seconds} of every timed case
+    times = {}
+    for r in results['frames']:
+        # noiseless cases keep the names of baselines recorded before the specs axis
+        name = 'frame %(frame)d count %(count)d %(rules)s' % r
+        if r.get('specs', 'noiseless') != 'noiseless':
+            name += ' ' + r['specs']
+        times[name] = r['image_s']
+    for r in results['particles']:
+        times['size %(size)d noise %(noise).1f' % r] = r['image_s']
+    for r in results['stages']:
+        for name in r:
+            if name != 'size':
+                times['%s size %d' % (name, r['size'])] = r[name]/1000
+    return times
+
+
+def compare(results, baseline, threshold):
+    # cases slower than the baseline by more than threshold (0.2 is 20%)
+    new, old = case_times(results), case_times(baseline)
+    regressions = []
+    for name in sorted(new):
+        if name in old and new[name] - old[name] > max(old[name]*threshold, MIN_DELTA):
+            regressions.append((name, old[name], new[name]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quick', action='store_true', help='smaller grid')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the best is kept')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown')
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    results = run_suite(args.quick, args.repeat)
+    results['meta'] = {'numpy': np.__version__, 'quick': args.quick, 'repeat': args.repeat,
+        'seed': SEED}
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        print('\n%d regressions over %d%%' % (len(regressions), args.threshold*100))
+        for name, old, new in regressions:
+            print('  %s: %.4f s -> %.4f s' % (name, old, new))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
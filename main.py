@@ -1,21 +1,31 @@
 """This is the final version of the particle simulation program!"""
 import numpy as np
 import qtpy
-from qtpy import QtCore, QtGui, uic, QtWidgets, QtCore
+from qtpy import QtCore, uic, QtWidgets, QtCore
 from datetime import datetime
 import imageio as imgio
+import json
 import os
-import scipy.ndimage as sp_ndimage
-import skimage.draw as si_draw
-import skimage.filters as si_filters
-import skimage.morphology as si_morphology
-import skimage.transform as si_transform
-import skimage.util as si_util
 import sys
 
+from particle_simulation.annotations import write_annotations
+from particle_simulation.convert import to_uint8
+from particle_simulation.engine import ParticleGenerator, PARTICLE_SHAPES
+from particle_simulation.manifest import save_manifest, scene_manifest
+from particle_simulation.profiling import StageProfiler, summary_rows
+from particle_simulation.qtimage import array2pixmap
+from particle_simulation.qttable import ParticleTableModel
+from particle_simulation.qtworker import DatasetWorker, GenerationWorker, PreviewWorker, \
+    start_preview_worker, start_worker
+from particle_simulation.scene import Scene
+from particle_simulation.table import ParticleTable
+
 # get main.py path
 path = os.path.dirname(os.path.abspath(__file__))
 
+# ms the particle editor waits for its values to settle before drawing the preview
+PREVIEW_DELAY = 150
+
 # change current directory
 os.chdir(path)
 
@@ -90,6 +100,31 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
         # set up database
         self.setup_database()
 
+        # headless generator doing the actual image work
+        self.generator = ParticleGenerator(on_no_rules=self.no_rules)
+
+        # placed particles and layers of the displayed image, edits and
+        # tweaks only re-render what they change
+        self.scene = None
+        # True while the running generation draws into the displayed arrays
+        self.updating = False
+
+        # running image generation, if any
+        self.worker = None
+        self.worker_thread = None
+
+        # stage timings of the last generated image
+        self.profiler = StageProfiler()
+        self.profile = None
+        self.profileButton = QtWidgets.QPushButton('Timings', self)
+        self.profileButton.setEnabled(False)
+        self.profileButton.clicked.connect(self.show_profile)
+        self.statusBar.addPermanentWidget(self.profileButton)
+        # peak allocations of every stage, the next images are slower to generate
+        self.profile_memoryCheckBox = QtWidgets.QCheckBox('Trace memory', self)
+        self.profile_memoryCheckBox.toggled.connect(self.set_profile_memory)
+        self.statusBar.addPermanentWidget(self.profile_memoryCheckBox)
+
         # set up gui
         self.load_fromButton.clicked.connect(self.load_size)
         self.spin_slider(self.widthSlider, self.widthSpinBox)
@@ -112,16 +147,29 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
         # imageViewer
         self.setup_imageViewer()
 
+        # editor previews are drawn on their own thread, the request id of
+        # the last one asked for is the only one displayed
+        self.preview_id = 0
+        self.preview_worker = PreviewWorker(ParticleGenerator())
+        self.preview_worker.done.connect(self.preview_ready)
+        self.preview_worker.failed.connect(self.preview_failed)
+        self.preview_thread = start_preview_worker(self.preview_worker)
+        self.preview_timer = QtCore.QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DELAY)
+        self.preview_timer.timeout.connect(self.update_particleViewer_2)
+
         # particle_detail
         self.setup_particle_widgets()        
         self.setup_particle_detailTable()
         
         # save
         self.save_imageButton.clicked.connect(self.save_image)
-        #self.save_dataButton.clicked.connect(self.save_data)
+        self.save_dataButton.clicked.connect(self.save_data)
 
         self.resetButton.clicked.connect(self.reset_particle)
         self.refreshButton.clicked.connect(self.update_imageViewer)
+        self.refresh_text = self.refreshButton.text()
 
         self.setWindowTitle("Particle Simulation")
     """
@@ -162,305 +210,32 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
             noise = self.noiseDoubleSpinBox.value()
             rotation = self.rotationSpinBox.value()
 
-            for i in range(amount):
-                # generate particle 
-                coords = self.generate_shape(shape)
-                polygon = self.apply_size(coords, size)
-                
-                # add particle info to the database
-                particle_number = str(len(self.database['particle']))
-                
-                self.database['particle'][str(particle_number)] = {'shape':shape, 'size':size, 
-                    'noise':noise, 'rotation':rotation, 'coords':coords, 'polygon':polygon}
-
-                # display particle on the table
-                model = self.particle_detailTable.model()
-                row_no = model.rowCount() + 1
-                row_data = [ shape, str(size), str(noise), str(rotation)]
-
-                row_item = []
-                for ii in row_data:
-                    row_item.append(QtGui.QStandardItem(ii))
-                
-                model.appendRow(row_item)
+            # add particle info to the database, the table shows it
+            particles = [self.generator.new_particle(shape, size, noise, rotation)
+                for i in range(amount)]
+            self.particle_detailTable.model().append(particles)
 
         self.amountSpinBox.setValue(0)
 
 
-    def apply_size(self, coords, size):
-        if coords is None:
-            # in this case we draw a circle
-            rr, cc = si_draw.circle(size, size, size)
-        elif coords == 'ellipse':
-            major, minor = [int(i) for i in size.split(';')]
-            # drawing 0 degree ellipse
-            rr, cc = si_draw.ellipse(minor, major, minor, major, rotation=0)
-        else:
-            x = self.shift_coords(size*coords['x'])/4
-            y = self.shift_coords(size*coords['y'])/4
-            rr, cc = si_draw.polygon(y, x)
-            
-        return({'rr':rr, 'cc': cc})
-
     def change_image(self):
+        if 'binary_image' not in self.database:
+            return
         img_type = self.image_typeComboBox.currentText()
         if img_type == 'Binary Image (Particles only)':
-            try:
-                self.display_image(self.database['binary_image']['name'])
-            except:
-                imgio.imsave(self.database['binary_image']['name'], self.database['binary_image']['data'])
-                self.display_image(self.database['binary_image']['name'])
+            self.display_image(self.database['binary_image']['data'])
         elif img_type == 'Particle+Noise':
-            try:
-                self.display_image(self.database['particle_bkg_image']['name'])
-            except:
-                imgio.imsave(self.database['particle_bkg_image']['name'], self.database['particle_bkg_image']['data'])
-                self.display_image(self.database['particle_bkg_image']['name'])
-
-    def crop_control(self, img, center_x, center_y, half_x, half_y, padding):
-        # control noise generated
-        # retrun image contain particle with padded noise  
-        w = img.shape[1]
-        h = img.shape[0]
-        
-        x_min = center_x - padding*half_x
-        if x_min > 0:
-            img[:, 0:x_min] = 0
-
-        x_max = center_x + padding*half_x
-        if x_max < w:
-            img[:, x_max:w] = 0
-        
-        y_min = center_y - padding*half_y
-        if y_min > 0:
-            img[0:y_min, :] = 0
-        
-        y_max = center_y + padding*half_y
-        if y_max < h:
-            img[y_max:h, :] = 0
-
-        return(img)
+            self.display_image(self.database['particle_bkg_image']['data'])
 
     def delete_selected_particle(self):
         # remove selected particle from the database and the particle table
         
         model = self.particle_detailTable.model()
-        start = min(self.database['temp']['selected_row'])
-        count = (max(self.database['temp']['selected_row']) - min(self.database['temp']['selected_row'])) + 1
-        model.removeRows(start, count)
-
-        for i in self.database['temp']['selected_row']:
-            del(self.database['particle'][str(i)])
-
-        particle = self.database['particle']
-        self.database['particle'] = {}
-        ind = 0
-        for i in particle:
-            self.database['particle'][str(ind)] = particle[i]
-            ind += 1 
+        model.delete(self.database['temp']['selected_row'])
         self.database['temp'] = {}
         
         self.reset_particle_widgets()
 
-    def draw_particle(self, particle, img):
-        w = img.shape[1]
-        h = img.shape[0]
-        rr = particle['polygon']['rr']
-        cc = particle['polygon']['cc']
-
-        not_edge = self.not_edgeCheckBox.isChecked()
-        not_attach = self.not_attachCheckBox.isChecked()
-
-        test = 0
-        tried = 1
-        while test == 0:
-
-            blank = np.zeros_like(img)
-            
-            rr_i, cc_i = self.rotate_particle(rr, cc, particle['rotation'])
-            rr_i, cc_i = rr_i.astype(int), cc_i.astype(int)
-
-            half_x = int(max(cc_i)/2)
-            half_y = int(max(rr_i)/2)
-
-            if not_edge:
-                x = int(self.rand(half_x, w - half_x))
-                y = int(self.rand(half_y, h - half_y))
-            else:
-                x = self.rand(0,w)
-                y = self.rand(0,h)
-            
-            rr_i = rr_i + y - half_y
-            cc_i = cc_i + x - half_x
-            
-            rr_i, cc_i = self.adjust_index(rr = rr_i, cc = cc_i, width = w, height = h)
-            
-
-            if not_attach and sum(img[rr_i, cc_i]) > 0:
-                test = 0
-                tried += 1
-            else:
-                blank[rr_i, cc_i] = 1
-                blank = self.apply_noise(blank, particle['noise'], (half_x+half_y)/2)
-                blank = self.crop_control(blank, x , y, half_x, half_y, padding = 2)
-                blank_close = self.closing(blank, size=particle['size'])
-                blank_test = self.dilate(blank_close, 5) # padding 5 pixels to make sure the particles don't touch
-                if not_attach and sum(img[blank_test.astype(bool)]) > 0: 
-                    test = 0
-                    tried += 1
-                else:
-                    img[blank_close.astype(bool)] = 1
-                    particle['binary'] = self.crop_center(blank_close, x - half_x, y - half_y)
-                    particle['polygon']['rr'], particle['polygon']['cc'] = np.nonzero(particle['binary'])
-                    particle['center'] = {'x': x - half_x, 'y': y - half_y}
-                    test = 1 # end while cycle 
-
-            if tried == 50:
-                self.no_rules()
-                tried = -1
-                
-        return(img)
-
-    def crop_center(self, img, center_x, center_y):
-        h, w = img.shape
-        xmin = center_x
-        xmax = center_x
-        ymin = center_y
-        ymax = center_y
-
-        while img[ymin, center_x] != 0 or np.sum(img[ymin, :]) != 0:
-            if ymin <= 0:
-                break
-            else:
-                ymin -= 1
-
-        while img[ymax, center_x] != 0 or np.sum(img[ymax, :]) != 0:
-            if ymax >= h:
-                break
-            else:
-                ymax += 1
-
-        while img[center_y, xmin] != 0 or np.sum(img[:, xmin]) != 0:
-            if xmin <= 0:
-                break
-            else:
-                xmin -= 1
-
-        while img[center_y, xmax] == 1 or np.sum(img[:,xmax]) != 0:
-            if xmax >= w:
-                break
-            else:
-                xmax += 1
-
-        return (img[ymin+1:ymax, xmin+1:xmax])
-
-    def draw_on(self, add, center_x, center_y, img, option = 'not_edge'):
-        x = add.shape[1]
-        y = add.shape[0]
-
-        w = img.shape[1]
-        h = img.shape[0]
-        
-        start_x = center_x - int(x/2)
-        stop_x = start_x + x
-
-        start_y = center_y - int(y/2)
-        stop_y = y + start_y
-
-        if option is 'no_rule':
-            if start_x < 0:
-                start_x =0
-            if stop_x > w:
-                res = stop_x - w
-                add = add[:, 0:x-res]
-                stop_x = w
-            if start_y < 0:
-                start_y = 0
-            if stop_y > h:
-                res = stop_y - h
-                add = add[0:y-res, :]
-                stop_y = h
-
-        img[start_y:stop_y, start_x:stop_x] = add
-        return(img)
-
-    def dilate(self, img, val):
-        # structure
-        struct = si_morphology.disk(val)
-        return(si_morphology.binary_dilation(img, struct))
-
-    def load_particle(self, particle, img):
-        particle_binary = particle['binary']
-        
-        not_edge = self.not_edgeCheckBox.isChecked()
-        not_attach = self.not_attachCheckBox.isChecked()
-        test = 0
-        tried = 1
-
-        while test == 0:
-            blank = np.zeros_like(img)
-            w = img.shape[0]
-            h = img.shape[1]
-
-            if not_edge:
-                test_1 = 0
-                while test_1 == 0:
-                    x = int(self.rand(particle['size']*3/2, w - particle['size']*3/2))
-                    y = int(self.rand(particle['size']*3/2, h - particle['size']*3/2))
-                    blank_particle = np.copy(blank)
-                    try:
-                        blank_particle = self.draw_on(particle_binary, x,y,blank_particle)
-                        test_1 = 1
-                    except:
-                        pass
-            else:
-                x = self.rand(0,w)
-                y = self.rand(0,h)
-                blank_particle = np.copy(blank)
-                blank_particle = self.draw_on(particle_binary, x,y,blank_particle)
-            
-            blank_test = self.dilate(np.copy(blank_particle), 5)
-
-            if not_attach and sum(img[blank_test.astype(bool)]) > 0:
-                test = 0
-                tried += 1
-            else:
-                img[blank_particle.astype(bool)] = 1
-                test = 1
-        
-            if tried == 50: 
-                self.no_rules()
-                tried = -1
-        particle['center'] = {'x':x, 'y':y}
-        return(img)
-
-
-    def closing(self, img, val = 0, size=None):
-        # structure
-        if size != None:
-            if size> 20:
-                val = 2
-            elif size > 10:
-                val = 1
-            else:
-                val = 0
-                
-        struct = si_morphology.disk(val)
-        return(si_morphology.binary_closing(img, struct))
-
-    def adjust_index(self, rr, cc, width, height):
-        index_r = rr > 0  
-        index_r *= rr < height
-        index_c = cc > 0 
-        index_c *= cc < width
-        index = index_c*index_r
-        return(rr[index], cc[index])
-    
-    def apply_noise(self, img, noise_level, particle_size):
-        img = si_util.random_noise(img.astype(bool), mode='salt', amount = noise_level/2)
-        img = si_morphology.remove_small_objects(img.astype(bool), (particle_size)**2)
-        return(img)
-
     def coords2pixmap(self, coords):
         rr, cc = coords['rr'], coords['cc']
         try:
@@ -470,7 +245,7 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
             h = max(rr)*3
             self.database['temp']['particle_img_size'] = [h, w]
         
-        img = np.zeros([h,w])
+        img = np.zeros([h,w], dtype=bool)
         x = int(w/2)
         y = int(h/2)
         
@@ -481,24 +256,16 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
         cc = cc + x - half_x - min(cc)
         img[rr,cc] = 1
         
-        name = '.ptc_img.png'
-        imgio.imsave(name, img)
-        pixmap = QtGui.QPixmap()
-        pixmap.load(name)
-        os.remove(name)
-        
-        return(pixmap)
+        return(array2pixmap(img))
 
-    def display_image(self, image_name):
+    def display_image(self, img):
         # remove all old image
         scene = self.imageViewer.scene()
         scene.clear()
         scene = QtWidgets.QGraphicsScene()
         
-        # load and add new image to scene
-        pixmap = QtGui.QPixmap()
-        pixmap.load(image_name)
-        os.remove(image_name)
+        # convert and add new image to scene
+        pixmap = array2pixmap(img)
 
         scene.addPixmap(pixmap)
         self.imageViewer.setScene(scene)
@@ -538,94 +305,110 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
             minor_axe = self.ellipseDialog.children_widget['Minor Axe'].value()
             self.sizeSpinBox.setText(str(major_axe)+';'+str(minor_axe))
 
-    def generate_images(self):            
-        w = self.widthSpinBox.value()
-        h = self.heightSpinBox.value()
-
-        blank_bkg = np.zeros([h, w])
-        bkg = np.copy(blank_bkg)
-        binary_image = np.copy(blank_bkg)
-        # check for particle on the list
-        particles = self.database['particle']
-
-        if len(particles) > 0: 
-            for i in particles:
-                if self.hold_particleCheckBox.isChecked():
-                    try:
-                        binary_image = self.load_particle(particles[i], binary_image)
-                    except:
-                        binary_image = self.draw_particle(particles[i], binary_image)
-                else:
-                    binary_image = self.draw_particle(particles[i], binary_image)
-        self.database['binary_image'] = {'data':binary_image, 'name':'binary_image.png'}
-        
-        # generating background
-        bkg_intensity = self.bkgDoubleSpinBox.value()
-        if bkg_intensity > 0:
-            bkg += si_util.random_noise(blank_bkg, mean=bkg_intensity)
+    def generate_images(self):
+        # generate on a worker thread, images_generated receives the images
+        if self.worker_thread is not None:
+            self.worker_thread.wait()
+
+        # dicts of the particles still placed are the scene's own
+        table = self.database['particle']
+        config = self.get_config()
+        known = self.scene.index if self.scene is not None else None
+        particles = table.particles(self.generator, known=known)
+        if self.scene is None or not self.scene.updatable(config, particles):
+            # nothing changed since the last image: a new one with a new seed
+            self.scene = Scene(config, profiler=self.profiler)
+            table.clear_placement()
+            particles = table.particles(self.generator)
+            self.updating = False
+        else:
+            # the scene's layers are the displayed images, updated in place
+            self.updating = True
+        self.scene.configure(config)
+        self.worker = GenerationWorker(self.scene, particles)
+        self.worker.progress.connect(self.generation_progress)
+        self.worker.done.connect(self.images_generated)
+        self.worker.cancelled.connect(self.generation_cancelled)
+        self.worker.failed.connect(self.generation_failed)
+        self.worker.rules_dropped.connect(self.no_rules)
+
+        self.set_generating(True)
+        self.worker_thread = start_worker(self.worker)
+
+    def images_generated(self, images):
+        # the arrays are the worker's own, nothing is copied
+        self.database['binary_image'] = {'data':images['binary_image'], 'name':'binary_image.png'}
+        self.database['bkg_image'] = {'data': images['bkg_image'], 'name':'background_image.png'}
+        self.database['particle_bkg_image'] = {'data': images['particle_bkg_image'],
+            'name':'particle_background_image.png'}
+        # seed and particles the image can be rendered again from, None
+        # with the reason when it can't
+        self.database['manifest'] = None
+        if self.scene.replayable:
+            self.database['manifest'] = scene_manifest(self.scene.config, self.scene.seed,
+                self.scene.particles)
+        elif self.scene.config['hold_particle']:
+            self.database['manifest_note'] = 'held particles are not redrawn from the seed'
+        else:
+            self.database['manifest_note'] = 'particles were edited after the image was generated'
+        self.database['particle'].set_placement(self.scene.index)
+        self.profile = self.profiler.report()
+        self.profileButton.setEnabled(True)
 
-        self.database['bkg_image'] = {'data': bkg, 'name':'background_image.png'}
-        
-        # shadow
-        shadow = self.shadowDoubleSpinBox.value()
-        particle_shadow = np.copy(blank_bkg)
-        if shadow != 0:
-            particle_shadow = self.dilate(binary_image, int(shadow * 20)) - binary_image
-            
-        # merge particle with the background
-        contrast = self.contrastDoubleSpinBox.value()
+        self.set_generating(False)
+        self.statusBar.showMessage('Image generated')
+        self.change_image()
 
-        particle_bkg = np.copy(bkg)
-        if contrast != 1 and contrast != 0:
-            particle_bkg[binary_image.astype(bool)] /= 1-contrast
-            particle_bkg[particle_shadow.astype(bool)] *= 1-contrast/5
-        else:
-            particle_bkg[binary_image.astype(bool)] = 1    
-
-        gaussian_sigma = self.gaussianDoubleSpinBox.value()
-        if gaussian_sigma > 0:
-            particle_bkg = si_filters.gaussian(particle_bkg, sigma = gaussian_sigma)
-
-        self.database['particle_bkg_image'] = {'data': particle_bkg, 'name':'particle_background_image.png'}
-
-
-    def generate_shape(self, shape):
-        if shape == 'Octagon':
-            x = np.array([1, 3, 4, 4, 3, 1, 0, 0])
-            y = np.array([0, 0, 1, 3, 4, 4, 3, 1])
-            """
-            x = np.array([-0.5, 0.5, 1, 1, 0.5, -0.5, -1, -1, -0.5]) 
-            y = np.array([-1, -1, -0.5, 0.5, 1, 1, 0.5, -0.5, -1])"""
-            return {'x':x, 'y':y}
-        elif shape == 'Oct-Rand':
-            rand_16 = np.random.choice(np.arange(-1/6, 1/6, 0.05), size = 4, replace = False )
-            rand_13 = np.random.choice(np.arange(1/3, 1, 0.05), size = 8, replace = False)
-            x = (np.array([-rand_13[0], rand_16[0], rand_13[1], 1, rand_13[2], rand_16[1], -rand_13[3], -1]) + 1) * 2
-            y = (np.array([rand_13[4], 1, rand_13[5], rand_16[2], -rand_13[6], -1, -rand_13[7], rand_16[3]]) + 1) * 2
-            return{'x':x, 'y':y}
-        elif shape == 'Square':
-            x = np.array([0,4,4,0])
-            y = np.array([0,0,4,4])
-            """x = np.array([-1, 1, 1, -1])
-            y = np.array([1, 1, -1, -1])"""
-            return{'x':x, 'y':y}
-        elif shape == 'Quadrilateral':
-            rand = np.random.choice(np.arange(-1,1,0.05), size = 4, replace = False)
-            x = (np.array([rand[0], 1, rand[1], -1]) + 1) * 2
-            y = (np.array([1, rand[2], -1, rand[3]]) + 1) * 2
-            return{'x':x, 'y':y}
-        elif shape == 'Circle':
-            return None   
-        elif shape == 'Ellipse':
-            return 'ellipse'
+    def generation_progress(self, placed, total, retries):
+        self.statusBar.showMessage('Placed ' + str(placed) + '/' + str(total) +
+            ' particles, ' + str(retries) + ' retries')
+
+    def generation_cancelled(self):
+        self.set_generating(False)
+        self.statusBar.showMessage('Generation cancelled')
+        self.discard_images()
+
+    def generation_failed(self, msg):
+        self.set_generating(False)
+        self.msg_box('Image generation failed: ' + msg, 'Generation', 3)
+        self.discard_images()
+
+    def discard_images(self):
+        # an update stopped halfway left the displayed arrays partly drawn,
+        # the next refresh renders a whole new image
+        if not self.updating:
+            return
+        self.updating = False
+        for key in ['binary_image', 'bkg_image', 'particle_bkg_image', 'manifest']:
+            self.database.pop(key, None)
+        self.imageViewer.setScene(QtWidgets.QGraphicsScene())
+
+    def set_generating(self, generating):
+        # the refresh button cancels while generating, particle edits wait for the end
+        if not generating:
+            self.worker = None
+        self.refreshButton.setText('Cancel' if generating else self.refresh_text)
+        # the worker may be drawing into the displayed arrays, they are not redisplayed before the end
+        for button in [self.add_particleButton, self.save_imageButton, self.save_dataButton, self.resetButton,
+                self.particle_modifyButton, self.particle_deleteButton, self.image_typeComboBox]:
+            button.setEnabled(not generating)
+
+    def get_config(self):
+        # snapshot of the widget values as a generator config
+        return {
+            'width': self.widthSpinBox.value(),
+            'height': self.heightSpinBox.value(),
+            'background': self.bkgDoubleSpinBox.value(),
+            'contrast': self.contrastDoubleSpinBox.value(),
+            'shadow': self.shadowDoubleSpinBox.value(),
+            'gaussian': self.gaussianDoubleSpinBox.value(),
+            'not_edge': self.not_edgeCheckBox.isChecked(),
+            'not_attach': self.not_attachCheckBox.isChecked(),
+            'hold_particle': self.hold_particleCheckBox.isChecked(),
+        }
 
     def img2pixmap(self, img):
-        img_name = '.img.png'
-        imgio.imsave(img_name, img)
-        pixmap = QtGui.QPixmap()
-        pixmap.load(img_name)
-        os.remove(img_name)
-        return pixmap
+        return array2pixmap(img)
 
     def spin_slider(self, widget_a, widget_b):
         widget_a.valueChanged.connect(self.link_spin_slider)
@@ -664,7 +447,7 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
         else:
             name = name[0] + 'DoubleSlider'
             slider = self.findChild(QtWidgets.QSlider, name)
-            slider.setValue(value*100)
+            slider.setValue(int(round(value*100)))
 
     def load_size(self):
         # make a QFileDialog
@@ -691,8 +474,8 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
         self.update_interface()
 
     def no_rules(self):
-        self.not_edgeCheckBox.setCheck(False)
-        self.not_attachCheckBox.setCheck(False)
+        self.not_edgeCheckBox.setChecked(False)
+        self.not_attachCheckBox.setChecked(False)
 
         self.msg_box('The image size is too small for the particle. All rules are ignored',
             'Ignore Rule', 1)
@@ -744,37 +527,90 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
             self.particle_sizeSpinBox.setMaximum(999)
             self.particle_sizeSpinBox.setValue(size)
             self.particle_sizeSpinBox.editingFinished.connect(self.update_particleViewer_2)
+            self.particle_sizeSpinBox.valueChanged.connect(self.schedule_preview)
             
         self.update_particleViewer_2()
 
-    def rand(self, mn, mx, step=1):
-        return(np.random.choice(np.arange(mn,mx,step), size = 1, replace = False)[0])        
-
     def reset_particle(self):
-        self.setup_particle_detailTable()
         self.setup_database()
+        self.setup_particle_detailTable()
         self.update_interface()
         self.update_imageViewer()
 
-    def rotate_particle(self, rr, cc, angle_deg):
-        # rr is the y indexes of particles
-        # cc is the x indexes of the particles
-        # Methode: rotation de reference
-
-        if angle_deg != 0:
-            # fit particle to scikit image rotation algorithm
-            rr_1 = rr - np.min(rr)
-            cc_1 = cc - np.min(cc)
-            particle_img = np.zeros([max(rr_1)+1,max(cc_1)+1])
-            particle_img[rr_1,cc_1] = 1
-            img_out = si_transform.rotate(particle_img, angle_deg, resize = True).astype(int)
-
-            rr_out = np.nonzero(img_out)[0] + np.min(rr)
-            cc_out = np.nonzero(img_out)[1] + np.min(cc)
-        else:
-            rr_out, cc_out = rr, cc
+    def set_profile_memory(self, checked):
+        self.profiler.trace_allocations = checked
 
-        return(rr_out, cc_out)
+    def show_profile(self):
+        # summary of where the last image's generation time went
+        report = self.profile
+        dlg = QtWidgets.QDialog(self)
+        dlg.setWindowTitle('Generation timings')
+        grid = QtWidgets.QGridLayout()
+
+        rows = summary_rows(report)
+        table = QtWidgets.QTableWidget(len(rows), 5, dlg)
+        table.setHorizontalHeaderLabels(['Stage', 'Calls', 'Time (ms)', 'Share', 'Peak (MB)'])
+        for i, (name, calls, seconds, share, peak) in enumerate(rows):
+            values = [name, str(calls), '%.2f' % (seconds*1000), '%.1f%%' % (share*100),
+                '%.2f' % peak if peak else '']
+            for j, value in enumerate(values):
+                table.setItem(i, j, QtWidgets.QTableWidgetItem(value))
+        table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        table.resizeColumnsToContents()
+        grid.addWidget(table, 0, 0, 1, 2)
+
+        attempts = ', '.join(k + ': ' + str(v) for k, v in report['attempts'].items())
+        batch = report['counters'].get('batch_particles', 0)
+        label = QtWidgets.QLabel('Total: %.1f ms\nPlacement attempts per particle (tries: particles): %s'
+            '\nParticles placed in batches: %d' % (report['total_seconds']*1000, attempts or '-', batch), dlg)
+        label.setWordWrap(True)
+        grid.addWidget(label, 1, 0, 1, 2)
+
+        export_button = QtWidgets.QPushButton('Export JSON', dlg)
+        grid.addWidget(export_button, 2, 0)
+        close_button = QtWidgets.QPushButton('Close', dlg)
+        grid.addWidget(close_button, 2, 1)
+
+        def export():
+            clock = datetime.now().strftime('%y%m%d_%H%M%S')
+            file_name = QtWidgets.QFileDialog.getSaveFileName(dlg, 'Export timings',
+                clock + '_timings.json', 'JSON (*.json)')[0]
+            if file_name:
+                with open(file_name, 'w') as f:
+                    json.dump([report], f, indent=1)
+
+        export_button.clicked.connect(export)
+        close_button.clicked.connect(dlg.accept)
+        dlg.setLayout(grid)
+        dlg.resize(520, 420)
+        dlg.exec_()
+        return dlg
+
+    def save_data(self):
+        # COCO style annotations of the displayed image, taken from the placed
+        # particles, and the manifest it can be rendered again from
+        if 'binary_image' not in self.database:
+            self.msg_box('Generate an image first', 'Save Data', 1)
+            return
+        table = self.database['particle']
+        if not table.column('placed').all():
+            self.msg_box('Particles were changed since the last image, refresh it first',
+                'Save Data', 1)
+            return
+        particles = table.particles(self.generator, known=self.scene.index)
+
+        clock = datetime.now().strftime('%y%m%d_%H%M%S')
+        file_name = QtWidgets.QFileDialog.getSaveFileName(self, 'Save annotations',
+            clock + '.json', 'COCO json (*.json)')[0]
+        if file_name:
+            write_annotations(file_name, particles, self.database['binary_image']['data'].shape,
+                image_file=self.database['binary_image']['name'])
+            if self.database['manifest'] is None:
+                self.statusBar.showMessage('Saved ' + file_name + ', no manifest: '
+                    + self.database['manifest_note'])
+                return
+            save_manifest(file_name.rsplit('.', 1)[0] + '_manifest.json', self.database['manifest'])
+            self.statusBar.showMessage('Saved ' + file_name)
 
     def save_image(self):
         duplicate = self.duplicateSpinBox.value()
@@ -789,42 +625,56 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
             if  file_dialog.exec():
                 file_path = file_dialog.selectedFiles()[0]
 
-                for i in range(duplicate):
-                    # get image name
-                    img_name = file_path + '/' + clock + '_' + str(i+1) + '.png'
-                    
-                    if img_type == 'Binary Image (Particles only)':
-                        if i != 0:
-                            del(self.database['binary_image']) 
-                        try:
-                            # save particle binary image
-                            imgio.imsave(img_name, self.database['binary_image']['data'])
-                                                   
-                        except:
-                            # generate new image file
-                            self.generate_images()
-                            imgio.imsave(img_name, self.database['binary_image']['data'])
-
-                        # remove saved data   
-
-                    elif img_type == 'Particle+Noise':
-                        if i != 0:
-                            del(self.database['particle_bkg_image']) 
-                        try:
-                            # save particle with background noise
-                            imgio.imsave(img_name, self.database['particle_bkg_image']['data'])
-
-                        except:
-                            # generate new image file
-                            self.generate_images()
-                            imgio.imsave(img_name, self.database['particle_bkg_image']['data'])
-                           
-        self.change_image()
+                if img_type == 'Binary Image (Particles only)':
+                    image_type = 'binary_image'
+                elif img_type == 'Particle+Noise':
+                    image_type = 'particle_bkg_image'
+
+                # the displayed image is the first duplicate, as it is
+                saved = 0
+                if image_type in self.database:
+                    imgio.imsave(os.path.join(file_path, clock + '_1.png'),
+                        to_uint8(self.database[image_type]['data']))
+                    saved = 1
+                if duplicate > saved:
+                    # the others are rendered by worker processes with their own
+                    # seeds, random shapes keep their coords
+                    config = self.get_config()
+                    config['particles'] = self.particle_specs()
+                    self.save_images(config, duplicate - saved, file_path, image_type=image_type,
+                        prefix=clock, start=saved)
+                else:
+                    self.statusBar.showMessage('Saved ' + os.path.join(file_path, clock + '_1.png'))
+
+    def save_images(self, config, count, file_path, **options):
+        # generate_dataset on a worker thread, Refresh cancels it like a generation
+        if self.worker_thread is not None:
+            self.worker_thread.wait()
+        self.updating = False
+        self.worker = DatasetWorker(config, count, file_path, **options)
+        self.worker.progress.connect(self.save_progress)
+        self.worker.done.connect(self.images_saved)
+        self.worker.cancelled.connect(self.generation_cancelled)
+        self.worker.failed.connect(self.generation_failed)
+
+        self.set_generating(True)
+        self.worker_thread = start_worker(self.worker)
+
+    def save_progress(self, done, count, file_name):
+        self.statusBar.showMessage('Saved ' + str(done) + '/' + str(count) + ': ' + file_name)
+
+    def images_saved(self, file_names):
+        self.set_generating(False)
+        self.statusBar.showMessage('Images saved to ' + os.path.dirname(file_names[-1]))
+
+    def particle_specs(self):
+        # particles of the database as generator specs
+        return self.database['particle'].specs()
     
     def setup_database(self):
         self.database = {
             "size": {'w':500, 'h':500},
-            "particle": {},
+            "particle": ParticleTable(),
             'temp':{},
         }
     
@@ -893,9 +743,12 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
         # set value to zeros
         self.particle_sizeSpinBox = self.switch_class(self.particle_sizeSpinBox, QtWidgets.QSpinBox)
         self.particle_sizeSpinBox.setValue(0)
+        self.particle_sizeSpinBox.editingFinished.connect(self.update_particleViewer_2)
+        self.particle_sizeSpinBox.valueChanged.connect(self.schedule_preview)
         self.particle_shapeComboBox.setCurrentIndex(0)
         self.particle_noiseDoubleSpinBox.setValue(0)
         self.particle_rotationSpinBox.setValue(0)
+        self.cancel_preview()
 
         self.database['temp'] = {}
         # reset viewer
@@ -909,22 +762,11 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
             viewer.fitInView(scene.sceneRect(), 1)
 
     def save_modified_particle(self):
+        self.finish_preview()
         model = self.particle_detailTable.model()
-        for i in self.database['temp']['selected_row']:
-            new_data = self.database['temp']['new_particle']
-            self.database['particle'][str(i)] = new_data
-            
-        
-            # update particle data
-            row_data = [new_data['shape'],
-                str(new_data['size']), str(new_data['noise']),
-                str(new_data['rotation'])]
-            
-            row_item = []
-            for ii in row_data:
-                row_item.append(QtGui.QStandardItem(ii))
-            model.removeRow(i)
-            model.insertRow(i, row_item)
+        new_data = self.database['temp']['new_particle']
+        # every row gets its own uid, the next image places them again
+        model.replace(self.database['temp']['selected_row'], new_data)
 
         self.database['temp']['old_particle'] = new_data
         self.display_particle(option=1, particle_polygon = new_data['polygon'])
@@ -946,7 +788,7 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
             self.database['temp']['new_particle'] = data
         else:
             # update particle_widgets
-            data = self.database['particle'][str(rows[0])]
+            data = self.database['particle'].particle(self.generator, rows[0])
 
             self.database['temp']['old_particle'] = data
             self.database['temp']['new_particle'] = data
@@ -973,8 +815,7 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
         # self.update_imageViewer()
 
     def setup_particleShape(self):
-        self.database['particle_shape'] = ['Octagon', 'Oct-Rand', 
-            'Square', 'Quadrilateral', 'Circle', 'Ellipse']
+        self.database['particle_shape'] = list(PARTICLE_SHAPES)
         for shape in self.database['particle_shape']:
             self.shapeComboBox.addItem(shape)
             self.particle_shapeComboBox.addItem(shape)
@@ -992,6 +833,10 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
         self.particle_sizeSpinBox.editingFinished.connect(self.update_particleViewer_2)
         self.particle_noiseDoubleSpinBox.editingFinished.connect(self.update_particleViewer_2)
         self.particle_rotationSpinBox.editingFinished.connect(self.update_particleViewer_2)
+        # scrubbing a value previews it once it settles
+        self.particle_sizeSpinBox.valueChanged.connect(self.schedule_preview)
+        self.particle_noiseDoubleSpinBox.valueChanged.connect(self.schedule_preview)
+        self.particle_rotationSpinBox.valueChanged.connect(self.schedule_preview)
         self.particle_shapeComboBox.currentIndexChanged.connect(self.particle_shapeComboBox_indexChange)
 
         self.particle_modifyButton.clicked.connect(self.save_modified_particle)
@@ -1000,11 +845,8 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
     def setup_particle_detailTable(self):
         self.particle_detailTable = self.switch_class(self.particle_detailTable, QTableView)
 
-        col_name = ['Shape', 'Size', 'Noise', 'Rotation']
-        
-        col_num = len(col_name)
-        model = QtGui.QStandardItemModel(0, col_num, self.particle_detailTable)
-        model.setHorizontalHeaderLabels(col_name)
+        # the view reads the particle table itself
+        model = ParticleTableModel(self.database['particle'], self.particle_detailTable)
         self.particle_detailTable.setModel(model)
 
     def setup_ellipseSize(self):
@@ -1043,17 +885,6 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
         else:
             self.setup_normalSize()
 
-    def shift_coords(self, array):
-        mid = max(array)/2
-        array[array>mid] += 1
-        array[array<mid] -= 1
-        
-        mn = np.min(array)
-        if mn < 0:
-            return(array + abs(mn))
-        else:
-            return array
-
     def switch_class(self, widget, new_class):
         # change default QGraphicsView class with custom class
         
@@ -1069,9 +900,11 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
         return(widget)
 
     def update_imageViewer(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            return
         self.tabWidget.setCurrentWidget(self.image_viewerTab)
         self.generate_images()
-        self.change_image()
 
     def update_interface(self):
         self.widthSpinBox.setValue(self.database['size']['w'])
@@ -1084,64 +917,91 @@ class MainWindow(QtWidgets.QMainWindow, form_class): # Ui_MainWindow): #
         else:
             self.particle_sizeSpinBox = self.switch_class(self.particle_sizeSpinBox, QtWidgets.QSpinBox)
             self.particle_sizeSpinBox.setValue(size)
+            self.particle_sizeSpinBox.editingFinished.connect(self.update_particleViewer_2)
+            self.particle_sizeSpinBox.valueChanged.connect(self.schedule_preview)
+
+    def schedule_preview(self):
+        # a value is being scrubbed, the preview waits for it to settle
+        self.preview_timer.start()
+
+    def cancel_preview(self):
+        # drop the pending preview and the one being drawn
+        self.preview_timer.stop()
+        self.preview_id += 1
+
+    def preview_args(self, force=False):
+        # preview_particle arguments of the editor values, None if the preview
+        # already shows them; a shape that stays the same keeps its coords
+        previous = self.database['temp'].get('new_particle', {})
+        if not self.particle_modified() and not (force and 'binary' not in previous):
+            return None
+        new = self.database['temp']['new_particle']
+        if new is not previous and previous.get('shape') == new['shape'] and 'coords' in previous:
+            new['coords'] = previous['coords']
+        return (new['shape'], new['size'], new['noise'], new['rotation'], new.get('coords'))
 
     def update_particleViewer_2(self):
-        # redraw particle from the input in particle widgets
-        if self.particle_modified():
-            update_particleViewer = False
-            shape = self.database['temp']['new_particle']['shape']
-            size = self.database['temp']['new_particle']['size']
-            noise = self.database['temp']['new_particle']['noise']
-            rotation = self.database['temp']['new_particle']['rotation']
+        # redraw particle from the input in particle widgets, on the preview thread
+        self.preview_timer.stop()
+        args = self.preview_args()
+        if args is not None:
+            self.preview_id += 1
+            self.preview_worker.request(self.preview_id, *args)
+
+    def finish_preview(self):
+        # the editor's particle drawn right away if its preview isn't in yet
+        self.preview_timer.stop()
+        args = self.preview_args(force=True)
+        if args is not None:
+            self.preview_id += 1
+            self.preview_ready(self.preview_id, self.generator.preview_particle(*args))
+
+    def preview_failed(self, request_id, msg):
+        if request_id == self.preview_id:
+            self.statusBar.showMessage('Particle preview failed: ' + msg)
+
+    def preview_ready(self, request_id, particle):
+        if request_id != self.preview_id:
+            # the editor values changed since it was asked for
+            return
+        update_particleViewer = False
+        rr, cc = particle['polygon']['rr'], particle['polygon']['cc']
+        half_x = np.ceil((max(cc)-min(cc))/2).astype(int)
+        half_y = np.ceil((max(rr)-min(rr))/2).astype(int)
 
-            coords = self.generate_shape(shape)
-            polygon = self.apply_size(coords, size)
-            
-            rr, cc = polygon['rr'], polygon['cc']
-            rr_i, cc_i = self.rotate_particle(rr, cc, rotation)
-            
-            half_x = np.ceil((max(cc_i)-min(cc_i))/2).astype(int)
-            half_y = np.ceil((max(rr_i)-min(rr_i))/2).astype(int)
-
-            try:
-                # get existing particle shape 
-                x = int(self.database['temp']['particle_img_size'][1]/2)
-                y = int(self.database['temp']['particle_img_size'][0]/2)
-                if x <= 2*half_x or y <= 2*half_y:
-                    update_particleViewer = True
-                    raise Exception('Particle out of bound.')
-                elif x >= 3*half_x or y >= 3*half_y:
-                    update_particleViewer = True
-                    raise Exception('Refitted image.')
-            except:
-                w = int(half_x*6)
-                h = int(half_y*6)
-                self.database['temp']['particle_img_size'] = [h, w]
-                x = np.ceil(w/2).astype(int)
-                y = np.ceil(h/2).astype(int)
-
-            rr_i = ((rr_i  + y) - half_y) - min(rr_i)
-            cc_i = ((cc_i + x) - half_x) - min(cc_i) 
-
-            blank = np.zeros(self.database['temp']['particle_img_size'])
-            blank[rr_i, cc_i] = 1
-
-            blank = self.apply_noise(blank, noise, (half_x+half_y)/2)
-            blank = self.closing(blank, size=(half_x+half_y)/2)
-            particle_binary = self.crop_center(blank, x, y)
-            polygon['rr'], polygon['cc'] = np.nonzero(particle_binary)
-
-            self.database['temp']['new_particle'] = { 'shape':shape, 'size': size,'noise': noise,
-                'rotation':rotation, 'coords':coords, 'polygon':polygon, 'binary':particle_binary}
-
-            self.display_particle(option=2, particle_polygon=polygon)
-
-            if update_particleViewer:
-                self.display_particle(option=1, particle_polygon=self.database['temp']['old_particle']['polygon'])
-
-app = QtWidgets.QApplication(sys.argv)
-
-# Create OUR very own MainWindow
-myWindow = MainWindow()
-myWindow.show()
-app.exec_()
+        try:
+            # get existing particle shape 
+            x = int(self.database['temp']['particle_img_size'][1]/2)
+            y = int(self.database['temp']['particle_img_size'][0]/2)
+            if x <= 2*half_x or y <= 2*half_y:
+                update_particleViewer = True
+                raise Exception('Particle out of bound.')
+            elif x >= 3*half_x or y >= 3*half_y:
+                update_particleViewer = True
+                raise Exception('Refitted image.')
+        except:
+            self.database['temp']['particle_img_size'] = [int(half_y*6), int(half_x*6)]
+
+        self.database['temp']['new_particle'] = particle
+        self.display_particle(option=2, particle_polygon=particle['polygon'])
+
+        if update_particleViewer and 'old_particle' in self.database['temp']:
+            self.display_particle(option=1, particle_polygon=self.database['temp']['old_particle']['polygon'])
+
+    def closeEvent(self, event):
+        # a running generation stops at its next check, its thread must end first
+        if self.worker is not None:
+            self.worker.cancel()
+        if self.worker_thread is not None:
+            self.worker_thread.wait()
+        self.preview_thread.quit()
+        self.preview_thread.wait()
+        QtWidgets.QMainWindow.closeEvent(self, event)
+
+if __name__ == '__main__':
+    app = QtWidgets.QApplication(sys.argv)
+
+    # Create OUR very own MainWindow
+    myWindow = MainWindow()
+    myWindow.show()
+    app.exec_()
@@ -0,0 +1,14 @@
+"""Synthetic particle image generation."""
+from particle_simulation.engine import ParticleGenerator, PARTICLE_SHAPES, default_config
+from particle_simulation.dataset import generate_dataset, image_seeds
+from particle_simulation.manifest import load_manifest, replay
+from particle_simulation.morphology import kernel_stats
+from particle_simulation.templates import template_stats
+from particle_simulation.profiling import StageProfiler
+from particle_simulation.rng import RandomSource
+from particle_simulation.store import DatasetStore
+from particle_simulation.stream import ParticleStream, stream_samples
+from particle_simulation.annotations import coco_annotations, rle_decode, rle_encode
+from particle_simulation.tiled import TiledRenderer, render_tiled
+from particle_simulation.scene import Scene
+from particle_simulation.table import ParticleTable
@@ -0,0 +1,5 @@
+import sys
+
+from particle_simulation.cli import main
+
+sys.exit(main())
@@ -0,0 +1,94 @@
+"""Instance annotations of generated images: RLE masks, COCO json, records."""
+import json
+
+import numpy as np
+
+from particle_simulation.engine import PARTICLE_SHAPES
+from particle_simulation.store import particle_table
+
+# coco: one COCO style json per image, records: the PARTICLE_DTYPE rows in a .npy
+ANNOTATION_FORMATS = ['coco', 'records']
+
+
+def particle_pixels(particle, shape):
+    # (rows, cols) of the pixels of a placed particle inside an image of shape
+    rr, cc = np.nonzero(particle['binary'])
+    rr = rr + particle['position']['y']
+    cc = cc + particle['position']['x']
+    inside = (rr >= 0) & (rr < shape[0]) & (cc >= 0) & (cc < shape[1])
+    return(rr[inside], cc[inside])
+
+
+def rle_encode(rr, cc, shape):
+    # uncompressed COCO run length encoding of the pixels rr, cc: lengths of
+    # the alternating background and mask runs, in column major order
+    h, w = shape
+    index = np.unique(cc.astype(np.int64)*h + rr)
+    if len(index) == 0:
+        return {'size': [h, w], 'counts': [h*w]}
+    breaks = np.flatnonzero(np.diff(index) != 1) + 1
+    starts = index[np.concatenate([[0], breaks])]
+    stops = index[np.concatenate([breaks - 1, [len(index) - 1]])] + 1
+    edges = np.empty(2*len(starts) + 2, dtype=np.int64)
+    edges[0] = 0
+    edges[1:-1:2] = starts
+    edges[2:-1:2] = stops
+    edges[-1] = h*w
+    return {'size': [h, w], 'counts': np.diff(edges).tolist()}
+
+
+def rle_decode(rle):
+    # boolean mask of an uncompressed COCO run length encoding
+    h, w = rle['size']
+    values = np.arange(len(rle['counts'])) % 2 == 1
+    flat = np.repeat(values, rle['counts'])
+    return flat.reshape(w, h).T
+
+
+def coco_categories():
+    return [{'id': i + 1, 'name': shape} for i, shape in enumerate(PARTICLE_SHAPES)]
+
+
+def coco_annotations(particles, shape, image_id=1, file_name=None, first_id=1):
+    # COCO style dict of one image, the masks and boxes are read from the
+    # placed particles, nothing is segmented again
+    h, w = shape
+    annotations = []
+    for i, particle in enumerate(particles):
+        rr, cc = particle_pixels(particle, shape)
+        if len(rr) == 0:
+            bbox, center = [0, 0, 0, 0], None
+        else:
+            bbox = [int(cc.min()), int(rr.min()), int(cc.max() - cc.min() + 1),
+                int(rr.max() - rr.min() + 1)]
+            center = [float(cc.mean()), float(rr.mean())]
+        annotations.append({'id': first_id + i, 'image_id': image_id,
+            'category_id': PARTICLE_SHAPES.index(particle['shape']) + 1,
+            'segmentation': rle_encode(rr, cc, shape), 'area': int(len(rr)),
+            'bbox': bbox, 'center': center, 'iscrowd': 0,
+            'size': particle['size'], 'noise': float(particle['noise']),
+            'rotation': float(particle['rotation'])})
+    image = {'id': image_id, 'height': h, 'width': w}
+    if file_name is not None:
+        image['file_name'] = file_name
+    return {'images': [image], 'annotations': annotations, 'categories': coco_categories()}
+
+
+def write_annotations(file_name, particles, shape, annotation_format='coco', image_file=None):
+    # annotations of one image, file_name is a .json for coco, a .npy for records
+    if annotation_format == 'coco':
+        with open(file_name, 'w') as f:
+            json.dump(coco_annotations(particles, shape, file_name=image_file), f)
+    elif annotation_format == 'records':
+        np.save(file_name, particle_table(particles))
+    else:
+        raise ValueError('Unknown annotation format: ' + str(annotation_format))
+    return(file_name)
+
+
+def annotation_file(image_file, annotation_format):
+    # file written next to image_file
+    stem = image_file.rsplit('.', 1)[0]
+    if annotation_format == 'coco':
+        return stem + '.json'
+    return stem + '_particles.npy'
@@ -0,0 +1,107 @@
+"""Vectorised placement of many identical particles."""
+import numpy as np
+import scipy.ndimage as sp_ndimage
+
+# candidates drawn per missing particle on every pass
+OVERSAMPLE = 2
+
+
+def flat_pixels(y0, x0, dy, dx, shape):
+    # flat image index of every (candidate, offset) pixel, -1 outside the image
+    h, w = shape
+    rows = y0[:, None] + dy[None, :]
+    cols = x0[:, None] + dx[None, :]
+    inside = (rows >= 0) & (rows < h) & (cols >= 0) & (cols < w)
+    return np.where(inside, rows*w + cols, -1)
+
+
+def independent(edge_pixels, footprint_pixels):
+    # candidates (rows, in priority order) whose footprint doesn't reach the
+    # mask of a candidate with a higher priority; a connected footprint that
+    # reaches a mask always covers one of its edge pixels, so only the edges
+    # are stamped
+    n = edge_pixels.shape[0]
+    own = np.arange(n)
+    pixels = edge_pixels.ravel()
+    prio = np.repeat(own, edge_pixels.shape[1])
+    keep = pixels >= 0
+    if not keep.any():
+        return np.ones(n, dtype=bool)
+
+    # best priority stamped on every edge pixel
+    key = np.sort(pixels[keep]*n + prio[keep])
+    pixels, prio = key//n, key % n
+    first = np.ones(len(pixels), dtype=bool)
+    first[1:] = pixels[1:] != pixels[:-1]
+    stamped, best = pixels[first], prio[first]
+
+    found = np.clip(np.searchsorted(stamped, footprint_pixels), 0, len(stamped) - 1)
+    reached = (stamped[found] == footprint_pixels) & (footprint_pixels >= 0)
+    best = np.where(reached, best[found], own[:, None])
+    return best.min(axis=1) == own
+
+
+def place_batch(template, count, occupancy, rng, bounds, not_attach, margin, tries):
+    # top left corners of up to count copies of template['mask'], drawn on the
+    # occupancy image with their centers in bounds, (y_lo, y_hi, x_lo, x_hi);
+    # it stops early when a pool of at least tries candidates has no room
+    # left for a single particle; returns (y0, x0, rejected, passes) with
+    # rejected the candidates dropped for reaching a particle and passes the
+    # pass every particle was placed on, 1 for the first
+    h, w = occupancy.img.shape
+    flat_img = occupancy.img.reshape(-1)
+    mask = template['mask']
+    ey, ex = np.nonzero(mask & ~sp_ndimage.binary_erosion(mask))
+    fy, fx = np.nonzero(template['footprint'])
+    fy, fx = fy - margin, fx - margin
+    half_x = int(max(template['cc'])/2)
+    half_y = int(max(template['rr'])/2)
+
+    placed_y, placed_x, passes = [], [], []
+    rejected = 0
+    pool_y = np.zeros(0, dtype=int)
+    pool_x = np.zeros(0, dtype=int)
+    need = count
+    while need > 0:
+        # top up the candidate pool, same center rule as draw_particle
+        k = max(need*OVERSAMPLE, tries) - len(pool_y)
+        if k > 0:
+            y = rng.integers(bounds[0], bounds[1], size=k)
+            x = rng.integers(bounds[2], bounds[3], size=k)
+            pool_y = np.concatenate([pool_y, y - half_y + template['y0']])
+            pool_x = np.concatenate([pool_x, x - half_x + template['x0']])
+
+        if not_attach:
+            # drop the candidates reaching particles already drawn
+            pixels = flat_pixels(pool_y, pool_x, fy, fx, (h, w))
+            hit = (flat_img[np.maximum(pixels, 0)] != 0) & (pixels >= 0)
+            free = ~hit.any(axis=1)
+            rejected += len(free) - int(free.sum())
+            pool_y, pool_x = pool_y[free], pool_x[free]
+
+            # keep the candidates that don't reach each other
+            winners = independent(flat_pixels(pool_y, pool_x, ey, ex, (h, w)), pixels[free])
+            accepted = np.nonzero(winners)[0][:need]
+        else:
+            accepted = np.arange(min(need, len(pool_y)))
+
+        if len(accepted) == 0:
+            # as many tries as draw_particle makes found no room
+            break
+
+        if not_attach and len(accepted) == need:
+            # last pass: the candidates before the last accepted one lost to an
+            # accepted one, a later pass would have dropped them as hits
+            rejected += int(accepted[-1]) + 1 - len(accepted)
+        occupancy.add_many(template['mask'], pool_y[accepted], pool_x[accepted])
+        placed_y.append(pool_y[accepted])
+        placed_x.append(pool_x[accepted])
+        passes.append(np.full(len(accepted), len(passes) + 1))
+        need -= len(accepted)
+        pool_y = np.delete(pool_y, accepted)
+        pool_x = np.delete(pool_x, accepted)
+
+    if len(placed_y) == 0:
+        empty = np.zeros(0, dtype=int)
+        return(empty, empty, rejected, empty)
+    return(np.concatenate(placed_y), np.concatenate(placed_x), rejected, np.concatenate(passes))
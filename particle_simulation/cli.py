@@ -0,0 +1,140 @@
+"""Command line interface: python -m particle_simulation generate ..."""
+import argparse
+import json
+import os
+import sys
+import time
+
+import imageio as imgio
+
+from particle_simulation.annotations import ANNOTATION_FORMATS
+from particle_simulation.dataset import IMAGE_TYPES, OUTPUT_FORMATS, generate_dataset
+from particle_simulation.convert import to_uint8
+from particle_simulation.manifest import load_manifest, replay
+from particle_simulation.tiled import TILE, TILED_DTYPES, render_tiled
+
+
+def load_config(file_name):
+    # yaml or json run description, yaml needs PyYAML
+    with open(file_name) as f:
+        if os.path.splitext(file_name)[1].lower() in ['.yaml', '.yml']:
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('PyYAML is required to read ' + file_name)
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+    return config or {}
+
+
+def generate(args):
+    config = load_config(args.config)
+    start = time.time()
+
+    def progress(done, count, file_name):
+        if not args.quiet:
+            rate = done/(time.time() - start)
+            sys.stderr.write('\r%d/%d images, %.2f images/s' % (done, count, rate))
+
+    result = generate_dataset(config, args.count, args.out, workers=args.workers,
+        seed=args.seed, image_type=args.image_type, prefix=args.prefix,
+        callback=progress, output=args.format, image_dtype=args.dtype, chunk=args.chunk,
+        annotations=args.annotations, profile=args.profile, profile_memory=args.profile_memory)
+
+    if args.format == 'manifest':
+        print(result)
+        return 0
+
+    elapsed = time.time() - start
+    if not args.quiet:
+        sys.stderr.write('\n')
+    print('%d images in %.2f s (%.2f images/s)' % (args.count, elapsed, args.count/elapsed))
+    return 0
+
+
+def tiled(args):
+    config = load_config(args.config)
+    if args.width is not None:
+        config['width'] = args.width
+    if args.height is not None:
+        config['height'] = args.height
+    start = time.time()
+
+    def progress(done, count):
+        if not args.quiet:
+            sys.stderr.write('\r%d/%d tiles' % (done, count))
+
+    file_names = render_tiled(config, args.out, tile=args.tile, seed=args.seed,
+        image_types=args.image_type, prefix=args.prefix, callback=progress)
+
+    if not args.quiet:
+        sys.stderr.write('\n')
+    for image_type in sorted(file_names):
+        print(file_names[image_type])
+    print('rendered in %.2f s' % (time.time() - start))
+    return 0
+
+
+def replay_image(args):
+    manifest = load_manifest(args.manifest)
+    images = replay(manifest, args.index)
+    imgio.imsave(args.out, to_uint8(images[args.image_type]))
+    print(args.out)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='particle_simulation',
+        description='Synthetic particle image generation.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    gen = commands.add_parser('generate', help='render a batch of images to a directory')
+    gen.add_argument('--config', required=True, help='yaml or json run description')
+    gen.add_argument('--count', type=int, default=1, help='number of images')
+    gen.add_argument('--workers', type=int, default=None, help='worker processes (default: all cores)')
+    gen.add_argument('--out', required=True, help='output directory')
+    gen.add_argument('--seed', type=int, default=None, help='seed of the whole batch')
+    gen.add_argument('--image-type', default='particle_bkg_image', choices=IMAGE_TYPES)
+    gen.add_argument('--prefix', default='image', help='file name prefix')
+    gen.add_argument('--format', default='png', choices=OUTPUT_FORMATS,
+        help='png files, a chunked store of images, masks and particle labels, '
+        'or only the manifest the images can be rendered again from')
+    gen.add_argument('--dtype', default='uint8', choices=['uint8', 'float32'],
+        help='image dtype of the store')
+    gen.add_argument('--chunk', type=int, default=None, help='images per chunk of the store')
+    gen.add_argument('--annotations', default=None, choices=ANNOTATION_FORMATS,
+        help='write the particle annotations next to every png')
+    gen.add_argument('--profile', default=None,
+        help='json file receiving the per-stage timings of every image')
+    gen.add_argument('--profile-memory', action='store_true',
+        help='also record the peak allocations of every stage (slower)')
+    gen.add_argument('--quiet', action='store_true', help='no progress output')
+    gen.set_defaults(func=generate)
+
+    rep = commands.add_parser('replay', help='render an image of a manifest again')
+    rep.add_argument('--manifest', required=True, help='manifest json written by generate')
+    rep.add_argument('--index', type=int, default=0, help='image of a dataset manifest, i for the file prefix_<i + 1>.png')
+    rep.add_argument('--out', required=True, help='png file')
+    rep.add_argument('--image-type', default='particle_bkg_image', choices=IMAGE_TYPES)
+    rep.set_defaults(func=replay_image)
+
+    til = commands.add_parser('tiled', help='render one large frame tile by tile to .npy files')
+    til.add_argument('--config', required=True, help='yaml or json run description')
+    til.add_argument('--width', type=int, default=None, help='frame width (overrides the config)')
+    til.add_argument('--height', type=int, default=None, help='frame height (overrides the config)')
+    til.add_argument('--tile', type=int, default=TILE, help='tile size in pixels')
+    til.add_argument('--out', required=True, help='output directory')
+    til.add_argument('--seed', type=int, default=None, help='seed of the frame')
+    til.add_argument('--image-type', action='append', choices=sorted(TILED_DTYPES),
+        help='image to write, may be repeated (default: all)')
+    til.add_argument('--prefix', default='image', help='file name prefix')
+    til.add_argument('--quiet', action='store_true', help='no progress output')
+    til.set_defaults(func=tiled)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
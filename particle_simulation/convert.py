@@ -0,0 +1,18 @@
+"""Conversion of generated images to 8 bit."""
+import numpy as np
+
+
+def to_uint8(img):
+    # same scaling as imageio used when the images were saved as png:
+    # bool and [0, 1] floats are scaled by 255, other floats are stretched
+    # from their min and max
+    if img.dtype == np.uint8:
+        return img
+    if img.dtype == bool:
+        return img.astype(np.uint8)*255
+    mn, mx = img.min(), img.max()
+    if mn >= 0 and mx <= 1:
+        return (img*255).astype(np.uint8)
+    if mx == mn:
+        return np.zeros(img.shape, dtype=np.uint8)
+    return ((img - mn)*(255/(mx - mn))).astype(np.uint8)
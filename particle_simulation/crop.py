@@ -0,0 +1,19 @@
+"""Bounding boxes of binary masks."""
+import numpy as np
+
+
+def bounding_box(img):
+    # (row_start, row_stop, col_start, col_stop) of the nonzero pixels, None if empty
+    rows = np.flatnonzero(img.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(img.any(axis=0))
+    return(rows[0], rows[-1] + 1, cols[0], cols[-1] + 1)
+
+
+def crop_nonzero(img):
+    # smallest crop holding every nonzero pixel, (0, 0) shaped if there is none
+    box = bounding_box(img)
+    if box is None:
+        return img[0:0, 0:0]
+    return img[box[0]:box[1], box[2]:box[3]]
@@ -0,0 +1,187 @@
+"""Generate many images in parallel and stream them to disk."""
+import multiprocessing
+import os
+
+import imageio as imgio
+import numpy as np
+
+from particle_simulation.annotations import ANNOTATION_FORMATS, annotation_file, write_annotations
+from particle_simulation.convert import to_uint8
+from particle_simulation.engine import ParticleGenerator, default_config
+from particle_simulation.manifest import dataset_manifest, save_manifest
+from particle_simulation.profiling import StageProfiler, save_reports
+from particle_simulation.store import CHUNK, DatasetStore, instance_mask, particle_table
+
+IMAGE_TYPES = ['particle_bkg_image', 'binary_image']
+
+# png: one file per image, store: a DatasetStore directory,
+# manifest: only the manifest the images can be rendered again from
+OUTPUT_FORMATS = ['png', 'store', 'manifest']
+
+
+def root_seed(seed):
+    # seed sequence of a whole dataset, None draws a fresh one
+    if isinstance(seed, np.random.SeedSequence):
+        return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key)
+    return np.random.SeedSequence(seed)
+
+
+def image_seeds(seed, count):
+    # one independent child seed per image, image i always gets the same one
+    return root_seed(seed).spawn(count)
+
+
+def render_image(config, seed):
+    generator = ParticleGenerator(config, seed=seed)
+    return generator.generate_images()
+
+
+def render_sample(job):
+    # worker entry point of the store output: the image as it is stored,
+    # its instance mask and its particle rows
+    index, config, seed, image_dtype, image_type, profile = job
+    generator = job_generator(config, seed, profile)
+    images = generator.generate_images()
+    img = images[image_type]
+    if np.dtype(image_dtype) == np.uint8:
+        img = to_uint8(img)
+    mask = instance_mask(generator.particles, img.shape)
+    return(index, img.astype(image_dtype), mask, particle_table(generator.particles, index),
+        job_report(generator))
+
+
+def job_generator(config, seed, profile):
+    # profile is None or the StageProfiler options of the job
+    profiler = StageProfiler(**profile) if profile is not None else None
+    return ParticleGenerator(config, seed=seed, profiler=profiler)
+
+
+def job_report(generator):
+    if generator.profiler is None:
+        return None
+    return generator.profiler.report()
+
+
+def save_image(job):
+    # worker entry point, kept at module level so it can be pickled
+    # the annotations are written from the placed particles in the same pass
+    index, config, seed, file_name, image_type, annotations, profile = job
+    generator = job_generator(config, seed, profile)
+    images = generator.generate_images()
+    imgio.imsave(file_name, to_uint8(images[image_type]))
+    if annotations is not None:
+        write_annotations(annotation_file(file_name, annotations), generator.particles,
+            images[image_type].shape, annotations, image_file=os.path.basename(file_name))
+    return(index, file_name, job_report(generator))
+
+
+def run_jobs(function, jobs, workers):
+    # results of function over jobs, in completion order
+    if workers == 1:
+        for result in map(function, jobs):
+            yield result
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(function, jobs):
+            yield result
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+
+def generate_dataset(config, count, out_dir, workers=None, seed=None,
+        image_type='particle_bkg_image', prefix='image', callback=None,
+        output='png', image_dtype='uint8', chunk=None, annotations=None, profile=None, profile_memory=False, start=0):
+    # render count images with a pool of workers
+    # png output: each image is written by the worker as soon as it is done,
+    # the file names are returned; prefix_manifest.json holds the seed and
+    # the config every image can be rendered again from; the files are
+    # numbered from start + 1, after images already saved with the prefix
+    # annotations (None, 'coco' or 'records') are written next to the pngs
+    # store output: images, instance masks and particle rows are appended to
+    # the DatasetStore in out_dir (image_dtype, chunk), which is returned
+    # profile is a json file receiving the per-stage timings of every image,
+    # with profile_memory their peak allocations too
+    # callback(done, count, file_name) is called in the parent for every image
+    if image_type not in IMAGE_TYPES:
+        raise ValueError('Unknown image type: ' + str(image_type))
+    if output not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format: ' + str(output))
+    if annotations is not None and annotations not in ANNOTATION_FORMATS:
+        raise ValueError('Unknown annotation format: ' + str(annotations))
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    root = root_seed(seed)
+    manifest = dataset_manifest(config, count, root, start)
+    if output == 'manifest':
+        return(save_manifest(os.path.join(out_dir, prefix + '_manifest.json'), manifest))
+
+    seeds = root.spawn(count)
+    reports = [None]*count
+    profiling = None if profile is None else {'trace_allocations': profile_memory}
+    if output == 'store':
+        store = generate_store(config, count, out_dir, workers, seeds,
+            image_type, image_dtype, chunk, callback, profiling, reports, manifest)
+        if profile is not None:
+            save_reports(profile, reports)
+        return(store)
+
+    jobs = []
+    for i in range(count):
+        file_name = os.path.join(out_dir, prefix + '_' + str(start + i + 1) + '.png')
+        jobs.append((i, config, seeds[i], file_name, image_type, annotations, profiling))
+
+    file_names = [None]*count
+    done = 0
+    for index, file_name, report in run_jobs(save_image, jobs, workers):
+        file_names[index] = file_name
+        reports[index] = report
+        done += 1
+        if callback is not None:
+            callback(done, count, file_name)
+    if profile is not None:
+        save_reports(profile, reports)
+    save_manifest(os.path.join(out_dir, prefix + '_manifest.json'), manifest)
+
+    return(file_names)
+
+
+def generate_store(config, count, out_dir, workers, seeds, image_type, image_dtype, chunk,
+        callback, profile, reports, manifest):
+    # the parent is the only writer, the store is extended when it
+    # already holds images; the manifest of every batch is kept in the index
+    full = default_config()
+    full.update(config)
+    if os.path.exists(os.path.join(out_dir, 'index.json')):
+        store = DatasetStore(out_dir, mode='r+')
+        # checked before anything is written, a failed batch leaves the store as it was
+        index = store.index
+        if (full['height'], full['width']) != (index['height'], index['width']):
+            raise ValueError('Store ' + out_dir + ' holds ' + str(index['width']) + 'x'
+                + str(index['height']) + ' images, the config renders ' + str(full['width'])
+                + 'x' + str(full['height']))
+        if np.dtype(image_dtype).name != index['image_dtype']:
+            raise ValueError('Store ' + out_dir + ' holds ' + index['image_dtype']
+                + ' images, not ' + np.dtype(image_dtype).name)
+    else:
+        store = DatasetStore.create(out_dir, full['height'], full['width'],
+            chunk=chunk or CHUNK, image_dtype=image_dtype, config=config)
+    start = len(store)
+    store.index.setdefault('manifests', []).append(dict(manifest, start=start))
+
+    jobs = [(i, config, seeds[i], store.index['image_dtype'], image_type, profile)
+        for i in range(count)]
+    done = 0
+    with store:
+        for index, img, mask, particles, report in run_jobs(render_sample, jobs, workers):
+            store.write(start + index, img, mask, particles)
+            reports[index] = report
+            done += 1
+            if callback is not None:
+                callback(done, count, out_dir)
+    return(store)
@@ -0,0 +1,668 @@
+"""Headless particle image generator, independent from the Qt interface."""
+import threading
+
+import numpy as np
+import skimage.draw as si_draw
+import skimage.filters as si_filters
+import skimage.transform as si_transform
+
+from particle_simulation import morphology
+from particle_simulation.batch import place_batch
+from particle_simulation.crop import bounding_box
+from particle_simulation.noise import noisy_masks
+from particle_simulation.occupancy import OccupancyGrid
+from particle_simulation.profiling import NULL_STAGE
+from particle_simulation.rng import RandomSource
+from particle_simulation.templates import TEMPLATES
+
+PARTICLE_SHAPES = ['Octagon', 'Oct-Rand', 'Square', 'Quadrilateral', 'Circle', 'Ellipse']
+
+# number of placement attempts before the placement rules are dropped
+MAX_TRIES = 50
+
+# free pixels kept around every particle when they must not attach
+ATTACH_MARGIN = 5
+
+# noise is kept within NOISE_PADDING half sizes of the particle center
+NOISE_PADDING = 2
+
+# extra border of the particle tile, larger than the closing radius
+TILE_PAD = 3
+
+# runs of identical noiseless particles at least this long are placed together
+BATCH_MIN = 8
+
+# standard deviation of the background noise, random_noise's default variance of 0.01
+BKG_SIGMA = 0.1
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+def default_config():
+    # plain dict mirroring the widgets of the main window
+    return {
+        'width': 500,
+        'height': 500,
+        'particles': [],
+        'background': 0.0,
+        'contrast': 0.0,
+        'shadow': 0.0,
+        'gaussian': 0.0,
+        'not_edge': False,
+        'not_attach': False,
+        'hold_particle': False,
+        # dtype of the intensity images, binary images are always bool
+        'dtype': 'float64',
+        # 'hard': uniform shadow ring, 'linear': fading out with the distance
+        'shadow_falloff': 'hard',
+    }
+
+SHADOW_FALLOFFS = ['hard', 'linear']
+
+
+def background_noise(generator, shape, mean, dtype=np.float64):
+    # skimage's random_noise(np.zeros(shape), mean=mean) drawn straight in dtype;
+    # float64 draws the same numbers as random_noise
+    noise = generator.standard_normal(shape, dtype=dtype)
+    noise *= BKG_SIGMA
+    noise += mean
+    return np.clip(noise, 0, 1, out=noise)
+
+
+def coords_key(coords):
+    # hashable version of generate_shape's output
+    if isinstance(coords, dict):
+        return (coords['x'].tobytes(), coords['y'].tobytes())
+    return coords
+
+
+class ParticleGenerator(object):
+    def __init__(self, config=None, on_no_rules=None, seed=None, on_progress=None, profiler=None):
+        self.config = default_config()
+        if config is not None:
+            self.config.update(config)
+
+        # every random draw goes through this generator, so a seed
+        # (int or np.random.SeedSequence) reproduces the whole image
+        self.rng = RandomSource(seed)
+
+        # called when the placement rules had to be dropped
+        self.on_no_rules = on_no_rules
+
+        # on_progress(placed, total, retries) is called as particles are placed,
+        # cancel() stops generate_images with GenerationCancelled, the running
+        # one or, when it comes before it started, the next one; every image
+        # ends with a new token, a late cancel never reaches the image after
+        self.on_progress = on_progress
+        self.cancel_event = threading.Event()
+        self.retries = 0
+
+        # optional StageProfiler timing the stages of every image
+        self.profiler = profiler
+
+        # index of the particles already drawn on the binary image
+        self.occupancy = None
+
+        # when only a tile of the frame is drawn: {'y', 'x'} offset of the
+        # image in the frame, 'height' and 'width' of the frame and 'core',
+        # the (y0, y1, x0, x1) frame range the particle centers are drawn in
+        self.window = None
+
+        # rasterised and rotated particles, shared between generators
+        self.templates = TEMPLATES
+
+        self.particles = []
+        for spec in self.config['particles']:
+            self.add_particle(spec)
+
+    def add_particle(self, spec):
+        # add spec['amount'] particles described by spec to the particle list,
+        # spec['coords'], if given, replaces the random part of the shape
+        for i in range(spec.get('amount', 1)):
+            if 'coords' in spec:
+                coords = spec['coords']
+                if isinstance(coords, dict):
+                    coords = {'x': np.array(coords['x']), 'y': np.array(coords['y'])}
+            else:
+                coords = self.generate_shape(spec['shape'])
+            self.particles.append(self.make_particle(spec['shape'], spec['size'],
+                spec.get('noise', 0.0), spec.get('rotation', 0), coords))
+        return(self.particles)
+
+    def new_particle(self, shape, size, noise, rotation):
+        return self.make_particle(shape, size, noise, rotation, self.generate_shape(shape))
+
+    def make_particle(self, shape, size, noise, rotation, coords):
+        if shape == 'Circle':
+            rotation = 0
+        template = self.templates.get(('polygon', shape, size, coords_key(coords)),
+            lambda: self.apply_size(coords, size))
+        polygon = {'rr': template['rr'], 'cc': template['cc']}
+        return {'shape': shape, 'size': size, 'noise': noise,
+            'rotation': rotation, 'coords': coords, 'polygon': polygon}
+
+    def preview_particle(self, shape, size, noise, rotation, coords=None):
+        # particle as generate_images draws it, binary mask included, for the
+        # editor; coords keeps the random part of the shape, None draws one
+        if coords is None:
+            coords = self.generate_shape(shape)
+        particle = self.make_particle(shape, size, noise, rotation, coords)
+        if noise == 0:
+            binary = self.particle_template(particle)['mask']
+        else:
+            self.synthesise_noise([particle])
+            binary = particle.pop('noise_mask')[0]
+        rr, cc = np.nonzero(binary)
+        particle['polygon'] = {'rr': rr, 'cc': cc}
+        particle['binary'] = binary
+        return(particle)
+
+    def generate_images(self, particles=None):
+        # return binary, background and particle+noise images
+        if particles is None:
+            particles = self.particles
+
+        self.retries = 0
+        if self.profiler is not None:
+            self.profiler.reset()
+        try:
+            binary_image = self.place_frame(particles)
+            bkg = self.background_image()
+            particle_bkg = self.render(binary_image, bkg)
+        finally:
+            self.end_run()
+
+        return {'binary_image': binary_image, 'bkg_image': bkg,
+            'particle_bkg_image': particle_bkg}
+
+    def place_frame(self, particles):
+        # binary image of particles placed on an empty frame
+        binary_image = np.zeros([self.config['height'], self.config['width']], dtype=bool)
+        self.occupancy = OccupancyGrid(binary_image, margin=ATTACH_MARGIN)
+        with self.stage('placement'):
+            return self.place_particles(particles, binary_image)
+
+    def background_image(self):
+        # background noise of the frame, drawn after the placement
+        w = self.config['width']
+        h = self.config['height']
+        dtype = np.dtype(self.config['dtype'])
+        bkg_intensity = self.config['background']
+        self.check_cancel()
+        with self.stage('background'):
+            if bkg_intensity > 0:
+                return background_noise(self.rng.generator, [h, w], bkg_intensity, dtype)
+            return np.zeros([h, w], dtype=dtype)
+
+    def place_particles(self, particles, img, placed=0, total=None):
+        # draw particles on the binary image img, placed and total are
+        # only used for the progress report
+        if total is None:
+            total = len(particles)
+        hold = self.config['hold_particle']
+        self.synthesise_noise([p for p in particles if not (hold and 'binary' in p)])
+        for group in self.particle_groups(particles):
+            if len(group) >= BATCH_MIN:
+                img = self.draw_batch(group, img)
+                placed += len(group)
+                self.progress(placed, total)
+                continue
+            for particle in group:
+                if self.config['hold_particle']:
+                    try:
+                        img = self.load_particle(particle, img)
+                    except Exception:
+                        img = self.draw_particle(particle, img)
+                else:
+                    img = self.draw_particle(particle, img)
+                placed += 1
+                self.progress(placed, total)
+        return(img)
+
+    def shadow_radius(self):
+        return(int(self.config['shadow'] * 20))
+
+    def render(self, binary_image, bkg):
+        # shadow, contrast and blur of the particles over the background
+        # shadow
+        binary = binary_image.astype(bool)
+        particle_shadow = np.zeros(bkg.shape, dtype=bool)
+        shadow_weight = None
+        if self.config['shadow'] != 0:
+            with self.stage('shadow'):
+                particle_shadow, shadow_weight = self.shadow(binary)
+
+        with self.stage('composite'):
+            particle_bkg = self.composite(binary, bkg, particle_shadow, shadow_weight)
+        return(self.blur(particle_bkg))
+
+    def composite(self, binary, bkg, particle_shadow, shadow_weight=None):
+        # merge particle with the background
+        self.check_cancel()
+        contrast = self.config['contrast']
+        particle_bkg = np.copy(bkg)
+        if contrast != 1 and contrast != 0:
+            particle_bkg[binary] /= 1-contrast
+            if shadow_weight is None:
+                particle_bkg[particle_shadow] *= 1-contrast/5
+            else:
+                particle_bkg[particle_shadow] *= 1-contrast/5*shadow_weight
+        else:
+            particle_bkg[binary] = 1
+        return(particle_bkg)
+
+    def blur(self, particle_bkg):
+        gaussian_sigma = self.config['gaussian']
+        if gaussian_sigma > 0:
+            self.check_cancel()
+            with self.stage('gaussian'):
+                particle_bkg = si_filters.gaussian(particle_bkg, sigma = gaussian_sigma)
+        return(particle_bkg)
+
+    def generate_shape(self, shape):
+        if shape == 'Octagon':
+            x = np.array([1, 3, 4, 4, 3, 1, 0, 0])
+            y = np.array([0, 0, 1, 3, 4, 4, 3, 1])
+            return {'x':x, 'y':y}
+        elif shape == 'Oct-Rand':
+            rand_16 = self.rng.choice(np.arange(-1/6, 1/6, 0.05), size = 4, replace = False )
+            rand_13 = self.rng.choice(np.arange(1/3, 1, 0.05), size = 8, replace = False)
+            x = (np.array([-rand_13[0], rand_16[0], rand_13[1], 1, rand_13[2], rand_16[1], -rand_13[3], -1]) + 1) * 2
+            y = (np.array([rand_13[4], 1, rand_13[5], rand_16[2], -rand_13[6], -1, -rand_13[7], rand_16[3]]) + 1) * 2
+            return {'x':x, 'y':y}
+        elif shape == 'Square':
+            x = np.array([0,4,4,0])
+            y = np.array([0,0,4,4])
+            return {'x':x, 'y':y}
+        elif shape == 'Quadrilateral':
+            rand = self.rng.choice(np.arange(-1,1,0.05), size = 4, replace = False)
+            x = (np.array([rand[0], 1, rand[1], -1]) + 1) * 2
+            y = (np.array([1, rand[2], -1, rand[3]]) + 1) * 2
+            return {'x':x, 'y':y}
+        elif shape == 'Circle':
+            return None
+        elif shape == 'Ellipse':
+            return 'ellipse'
+
+    def apply_size(self, coords, size):
+        if coords is None:
+            # in this case we draw a circle
+            rr, cc = si_draw.disk((size, size), size)
+        elif coords == 'ellipse':
+            major, minor = [int(i) for i in size.split(';')]
+            # drawing 0 degree ellipse
+            rr, cc = si_draw.ellipse(minor, major, minor, major, rotation=0)
+        else:
+            x = self.shift_coords(size*coords['x'])/4
+            y = self.shift_coords(size*coords['y'])/4
+            rr, cc = si_draw.polygon(y, x)
+
+        return({'rr':rr, 'cc': cc})
+
+    def shift_coords(self, array):
+        mid = max(array)/2
+        array[array>mid] += 1
+        array[array<mid] -= 1
+
+        mn = np.min(array)
+        if mn < 0:
+            return(array + abs(mn))
+        else:
+            return array
+
+    def rotate_particle(self, rr, cc, angle_deg):
+        # rr is the y indexes of particles
+        # cc is the x indexes of the particles
+        # Methode: rotation de reference
+
+        if angle_deg != 0:
+            # fit particle to scikit image rotation algorithm
+            rr_1 = rr - np.min(rr)
+            cc_1 = cc - np.min(cc)
+            particle_img = np.zeros([max(rr_1)+1,max(cc_1)+1])
+            particle_img[rr_1,cc_1] = 1
+            img_out = si_transform.rotate(particle_img, angle_deg, resize = True).astype(int)
+
+            rr_out = np.nonzero(img_out)[0] + np.min(rr)
+            cc_out = np.nonzero(img_out)[1] + np.min(cc)
+        else:
+            rr_out, cc_out = rr, cc
+
+        return(rr_out, cc_out)
+
+    def get_occupancy(self, img):
+        # occupancy index of img, rebuilt when drawing on another image
+        if self.occupancy is None or self.occupancy.img is not img:
+            self.occupancy = OccupancyGrid(img, margin=ATTACH_MARGIN)
+            box = bounding_box(img)
+            if box is not None:
+                self.occupancy.add(img[box[0]:box[1], box[2]:box[3]], box[0], box[2])
+        return self.occupancy
+
+    def particle_groups(self, particles):
+        # split particles in runs of consecutive identical noiseless particles,
+        # which are the ones that can be drawn from one template in a batch
+        groups = []
+        last_key = None
+        for particle in particles:
+            if self.config['hold_particle'] or particle['noise'] != 0:
+                key = None
+            else:
+                key = self.template_key(particle)
+            if key is None or key != last_key:
+                groups.append([])
+            groups[-1].append(particle)
+            last_key = key
+        return groups
+
+    def template_key(self, particle):
+        return ('particle', particle['shape'], particle['size'], particle['rotation'],
+            coords_key(particle['coords']))
+
+    def particle_template(self, particle):
+        # rotated pixels, closed mask and collision footprint of a particle,
+        # shared by the particles with the same shape, size, rotation and coords
+        with self.stage('template'):
+            return self.templates.get(self.template_key(particle),
+                lambda: self.build_template(particle))
+
+    def build_template(self, particle):
+        polygon = self.apply_size(particle['coords'], particle['size'])
+        with self.stage('rotate'):
+            rr, cc = self.rotate_particle(polygon['rr'], polygon['cc'], particle['rotation'])
+        rr, cc = rr.astype(int), cc.astype(int)
+
+        # mask of the noiseless particle, (y0, x0) is its top left corner in the rr, cc frame
+        tile = np.zeros([max(rr) + 1 + 2*TILE_PAD, max(cc) + 1 + 2*TILE_PAD], dtype=bool)
+        tile[rr + TILE_PAD, cc + TILE_PAD] = True
+        tile = self.closing(tile, size=particle['size'])
+        box = bounding_box(tile)
+        mask = tile[box[0]:box[1], box[2]:box[3]]
+
+        # mask grown by the attach margin, as tested by the occupancy grid
+        m = ATTACH_MARGIN
+        footprint = np.zeros([mask.shape[0] + 2*m, mask.shape[1] + 2*m], dtype=bool)
+        footprint[m:m + mask.shape[0], m:m + mask.shape[1]] = mask
+        footprint = self.dilate(footprint, m)
+
+        return {'rr': rr, 'cc': cc, 'mask': mask, 'footprint': footprint,
+            'y0': int(box[0]) - TILE_PAD, 'x0': int(box[2]) - TILE_PAD}
+
+    def draw_particle(self, particle, img):
+        w = img.shape[1]
+        h = img.shape[0]
+        occupancy = self.get_occupancy(img)
+
+        # rotation and rasterisation are done once, not on every try
+        template = self.particle_template(particle)
+        rr, cc = template['rr'], template['cc']
+        half_x = int(max(cc)/2)
+        half_y = int(max(rr)/2)
+
+        test = 0
+        tried = 1
+        while test == 0:
+            # rules are read on every try since no_rules may drop them
+            not_attach = self.config['not_attach']
+            y_lo, y_hi, x_lo, x_hi = self.center_bounds(half_x, half_y, h, w)
+            x = int(self.rand(x_lo, x_hi))
+            y = int(self.rand(y_lo, y_hi))
+
+            rr_i = rr + y - half_y
+            cc_i = cc + x - half_x
+
+            rr_i, cc_i = self.adjust_index(rr = rr_i, cc = cc_i, width = w, height = h)
+
+            with self.stage('collision'):
+                hit = not_attach and occupancy.hits(rr_i, cc_i)
+            if hit:
+                test = 0
+                tried += 1
+                self.retries += 1
+            else:
+                with self.stage('synthesise'):
+                    mask, y0, x0, footprint = self.synthesise_particle(particle,
+                        template, x, y, half_x, half_y)
+                with self.stage('collision'):
+                    hit = not_attach and occupancy.collides(mask, y0, x0, footprint)
+                if hit:
+                    test = 0
+                    tried += 1
+                    self.retries += 1
+                else:
+                    occupancy.add(mask, y0, x0)
+                    particle.pop('noise_mask', None)
+                    particle['binary'] = mask
+                    particle['polygon']['rr'], particle['polygon']['cc'] = np.nonzero(particle['binary'])
+                    particle['center'] = {'x': x - half_x, 'y': y - half_y}
+                    particle['position'] = {'x': x0, 'y': y0}
+                    self.attempts(tried)
+                    test = 1 # end while cycle
+
+            if tried == MAX_TRIES:
+                self.no_rules()
+                tried = -1
+
+        return(img)
+
+    def draw_batch(self, particles, img):
+        # place identical noiseless particles in vectorised passes
+        occupancy = self.get_occupancy(img)
+        template = self.particle_template(particles[0])
+
+        h, w = img.shape
+        half_x = int(max(template['cc'])/2)
+        half_y = int(max(template['rr'])/2)
+
+        with self.stage('place_batch'):
+            y0, x0, rejected, passes = place_batch(template, len(particles), occupancy, self.rng,
+                self.center_bounds(half_x, half_y, h, w), self.config['not_attach'],
+                ATTACH_MARGIN, MAX_TRIES)
+        if self.profiler is not None:
+            self.profiler.count('batch_particles', len(particles))
+        if len(y0) < len(particles):
+            # not enough room, the remaining particles are placed without rules
+            self.no_rules()
+            y1, x1, more, passes1 = place_batch(template, len(particles) - len(y0), occupancy,
+                self.rng, self.center_bounds(half_x, half_y, h, w), False, ATTACH_MARGIN, 1)
+            y0, x0 = np.concatenate([y0, y1]), np.concatenate([x0, x1])
+            rejected += more
+            passes = np.concatenate([passes, passes1])
+        # the candidates drawn for a pass are its tries, as draw_particle counts them
+        self.retries += rejected
+        for tries, n in zip(*np.unique(passes, return_counts=True)):
+            self.attempts(int(tries), int(n))
+
+        rr, cc = np.nonzero(template['mask'])
+        for i, particle in enumerate(particles):
+            particle['binary'] = template['mask']
+            particle['polygon']['rr'], particle['polygon']['cc'] = rr, cc
+            particle['center'] = {'x': int(x0[i] - template['x0']), 'y': int(y0[i] - template['y0'])}
+            particle['position'] = {'x': int(x0[i]), 'y': int(y0[i])}
+        return(img)
+
+    def synthesise_particle(self, particle, template, x, y, half_x, half_y):
+        # mask of the particle placed on x, y, its top left corner and its
+        # collision footprint (None when it has to be computed)
+        if particle['noise'] == 0:
+            # noiseless particles are stamped straight from their template
+            y0 = y - half_y + template['y0']
+            x0 = x - half_x + template['x0']
+            return(template['mask'], y0, x0, template['footprint'])
+
+        # noisy masks don't depend on the position, the one synthesised
+        # beforehand is kept over the retries
+        if 'noise_mask' not in particle:
+            self.synthesise_noise([particle])
+        mask, dy, dx = particle['noise_mask']
+        return(mask, y + dy, x + dx, None)
+
+    def synthesise_noise(self, particles):
+        # noisy mask of every noisy particle in particle['noise_mask'] until it
+        # is placed, runs of particles sharing their template and noise level
+        # are synthesised in one vectorised call
+        runs = []
+        last_key = None
+        for particle in particles:
+            key = None
+            if particle['noise'] != 0:
+                key = (self.template_key(particle), particle['noise'])
+                if key != last_key:
+                    runs.append([])
+                runs[-1].append(particle)
+            last_key = key
+
+        for run in runs:
+            template = self.particle_template(run[0])
+            rr, cc = template['rr'], template['cc']
+            with self.stage('noise'):
+                masks = noisy_masks(rr, cc, int(max(rr)/2), int(max(cc)/2), run[0]['noise'],
+                    self.closing_radius(run[0]['size']), len(run), self.rng.generator,
+                    NOISE_PADDING, TILE_PAD)
+            if self.profiler is not None:
+                self.profiler.count('noise_particles', len(run))
+            for particle, mask in zip(run, masks):
+                particle['noise_mask'] = mask
+
+    def load_particle(self, particle, img):
+        particle_binary = particle['binary']
+        occupancy = self.get_occupancy(img)
+        w = img.shape[1]
+        h = img.shape[0]
+        half_y, half_x = [int(np.ceil(i/2)) for i in particle_binary.shape]
+
+        test = 0
+        tried = 1
+        while test == 0:
+            not_attach = self.config['not_attach']
+            y_lo, y_hi, x_lo, x_hi = self.center_bounds(half_x, half_y, h, w)
+            x = int(self.rand(x_lo, x_hi))
+            y = int(self.rand(y_lo, y_hi))
+
+            # top left corner of the particle centered on x, y
+            y0 = y - int(particle_binary.shape[0]/2)
+            x0 = x - int(particle_binary.shape[1]/2)
+
+            with self.stage('collision'):
+                hit = not_attach and occupancy.collides(particle_binary, y0, x0)
+            if hit:
+                test = 0
+                tried += 1
+                self.retries += 1
+            else:
+                occupancy.add(particle_binary, y0, x0)
+                self.attempts(tried)
+                test = 1
+
+            if tried == MAX_TRIES:
+                self.no_rules()
+                tried = -1
+        particle['center'] = {'x':x, 'y':y}
+        particle['position'] = {'x': x0, 'y': y0}
+        return(img)
+
+    def center_bounds(self, half_x, half_y, h, w):
+        # [y_lo, y_hi) and [x_lo, x_hi) ranges of the particle centers on the
+        # h x w image, the edge rule applies to the frame, not to a tile
+        if self.window is None:
+            oy, ox, fh, fw = 0, 0, h, w
+            y_lo, y_hi, x_lo, x_hi = 0, h, 0, w
+        else:
+            oy, ox = self.window['y'], self.window['x']
+            fh, fw = self.window['height'], self.window['width']
+            y_lo, y_hi, x_lo, x_hi = self.window['core']
+
+        if self.config['not_edge']:
+            y_lo, y_hi = max(y_lo, half_y), min(y_hi, fh - half_y)
+            x_lo, x_hi = max(x_lo, half_x), min(x_hi, fw - half_x)
+        return(y_lo - oy, y_hi - oy, x_lo - ox, x_hi - ox)
+
+    def adjust_index(self, rr, cc, width, height):
+        index_r = rr > 0
+        index_r *= rr < height
+        index_c = cc > 0
+        index_c *= cc < width
+        index = index_c*index_r
+        return(rr[index], cc[index])
+
+    def closing(self, img, val = 0, size=None):
+        # structure
+        if size != None:
+            val = self.closing_radius(size)
+
+        with self.stage('closing'):
+            return(morphology.closing(img, val))
+
+    def closing_radius(self, size):
+        if type(size) is str:
+            # ellipse size is given as 'major;minor'
+            size = np.mean([int(i) for i in size.split(';')])
+        if size> 20:
+            return(2)
+        elif size > 10:
+            return(1)
+        return(0)
+
+    def shadow(self, binary):
+        # shadow ring around the particles and, for a graded falloff, the
+        # strength of its pixels in (0, 1], None when it is uniform
+        self.check_cancel()
+        radius = self.shadow_radius()
+        falloff = self.config['shadow_falloff']
+        if falloff not in SHADOW_FALLOFFS:
+            raise ValueError('Unknown shadow falloff: ' + str(falloff))
+        if falloff == 'hard':
+            return(morphology.ring(binary, radius)[0], None)
+
+        ring, distance = morphology.ring(binary, radius, distance=True)
+        # full strength next to the particle, fading to 1/radius at the rim
+        weight = 1 - (distance[ring] - 1)/radius
+        return(ring, weight.astype(self.config['dtype']))
+
+    def dilate(self, img, val):
+        return(morphology.dilate(img, val))
+
+    def stage(self, name):
+        # with self.stage(name): times the block when the generator is profiled
+        if self.profiler is None:
+            return NULL_STAGE
+        return self.profiler.stage(name)
+
+    def attempts(self, tries, n=1):
+        if self.profiler is not None:
+            self.profiler.attempts(tries, n)
+
+    def cancel(self):
+        # may be called from another thread, checked after every particle
+        # and before every render stage
+        self.cancel_event.set()
+
+    def cancel_token(self):
+        # event cancel() sets for the running image, or the next one if none
+        # is running; a worker keeps it so its cancel only reaches its own image
+        return self.cancel_event
+
+    def check_cancel(self):
+        if self.cancel_event.is_set():
+            raise GenerationCancelled()
+
+    def end_run(self):
+        # called when an image is done or stopped, a cancel after it is void
+        self.cancel_event = threading.Event()
+
+    def progress(self, placed, total):
+        self.check_cancel()
+        if self.on_progress is not None:
+            self.on_progress(placed, total, self.retries)
+
+    def no_rules(self):
+        # the image is too small for the particle, placement rules are dropped
+        self.config['not_edge'] = False
+        self.config['not_attach'] = False
+        if self.on_no_rules is not None:
+            self.on_no_rules()
+
+    def rand(self, mn, mx, step=1):
+        return(self.rng.rand(mn, mx, step))
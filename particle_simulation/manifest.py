@@ -0,0 +1,97 @@
+"""Compact manifests from which generated images are rendered again exactly."""
+import copy
+import json
+
+import numpy as np
+
+from particle_simulation.engine import ParticleGenerator, default_config
+
+MANIFEST_VERSION = 1
+
+
+def seed_state(seed):
+    # json form of a np.random.SeedSequence
+    return {'entropy': seed.entropy, 'spawn_key': list(seed.spawn_key)}
+
+
+def seed_sequence(state):
+    return np.random.SeedSequence(state['entropy'], spawn_key=tuple(state['spawn_key']))
+
+
+def coords_state(coords):
+    # json form of generate_shape's output
+    if isinstance(coords, dict):
+        return {'x': coords['x'].tolist(), 'y': coords['y'].tolist()}
+    return coords
+
+
+def particle_specs(particles):
+    # specs of a particle list, coords included so random shapes come back
+    # as they were; runs of identical particles share one spec
+    specs = []
+    for particle in particles:
+        spec = {'shape': particle['shape'], 'size': particle['size'],
+            'noise': particle['noise'], 'rotation': particle['rotation'],
+            'coords': coords_state(particle['coords']), 'amount': 1}
+        if specs and all(specs[-1][k] == spec[k] for k in spec if k != 'amount'):
+            specs[-1]['amount'] += 1
+        else:
+            specs.append(spec)
+    return(specs)
+
+
+def scene_manifest(config, seed, particles=None):
+    # manifest of one image: the full rendering config and the seed,
+    # particles replace config['particles'] when the scene was built by hand
+    full = default_config()
+    full.update(copy.deepcopy(config))
+    if particles is not None:
+        full['particles'] = particle_specs(particles)
+    return {'version': MANIFEST_VERSION, 'seed': seed_state(seed), 'config': full}
+
+
+def dataset_manifest(config, count, seed, start=0):
+    # manifest of a whole dataset, image start + i is rendered from the i-th
+    # child of seed
+    full = default_config()
+    full.update(copy.deepcopy(config))
+    return {'version': MANIFEST_VERSION, 'seed': seed_state(seed), 'count': count,
+        'start': start, 'config': full}
+
+
+def image_manifest(manifest, index):
+    # manifest of image index of a dataset manifest, counted like the saved
+    # images: index i is the file prefix_<i + 1>.png or the store image i
+    if 'count' not in manifest:
+        return manifest
+    start = manifest.get('start', 0)
+    if not start <= index < start + manifest['count']:
+        raise IndexError('Image ' + str(index) + ' not in a dataset of images '
+            + str(start) + ' to ' + str(start + manifest['count'] - 1))
+    root = seed_state(seed_sequence(manifest['seed']))
+    seed = {'entropy': root['entropy'], 'spawn_key': root['spawn_key'] + [index - start]}
+    return {'version': manifest['version'], 'seed': seed, 'config': manifest['config']}
+
+
+def replay_generator(manifest, index=0):
+    # generator ready to render the image of the manifest again
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('Unsupported manifest version: ' + str(manifest.get('version')))
+    manifest = image_manifest(manifest, index)
+    return ParticleGenerator(copy.deepcopy(manifest['config']), seed=seed_sequence(manifest['seed']))
+
+
+def replay(manifest, index=0):
+    # images of the manifest, identical to the ones first generated
+    return replay_generator(manifest, index).generate_images()
+
+
+def save_manifest(file_name, manifest):
+    with open(file_name, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return(file_name)
+
+
+def load_manifest(file_name):
+    with open(file_name) as f:
+        return json.load(f)
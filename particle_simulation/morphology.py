@@ -0,0 +1,110 @@
+"""Morphology helpers sharing one cache of structuring elements."""
+import numpy as np
+import scipy.ndimage as sp_ndimage
+import skimage.morphology as si_morphology
+
+from particle_simulation.crop import bounding_box
+
+
+class KernelCache(object):
+    def __init__(self):
+        self.kernels = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        # cached kernel for key, build() is only called on a miss
+        try:
+            kernel = self.kernels[key]
+            self.hits += 1
+        except KeyError:
+            kernel = build()
+            kernel.flags.writeable = False
+            self.kernels[key] = kernel
+            self.misses += 1
+        return kernel
+
+    def disk(self, radius):
+        return self.get(('disk', radius), lambda: si_morphology.disk(radius).astype(bool))
+
+    def offsets(self, radius):
+        # (2, n) row and column offsets of the disk pixels around its center
+        def build():
+            rows, cols = np.nonzero(self.disk(radius))
+            return np.array([rows - radius, cols - radius])
+        return self.get(('offsets', radius), build)
+
+    def stats(self):
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.kernels),
+            'hit_rate': self.hits/calls if calls else 0.0}
+
+    def clear(self):
+        self.kernels = {}
+        self.hits = 0
+        self.misses = 0
+
+
+# up to this radius a disk dilation is faster than a distance transform
+DILATE_RADIUS = 3
+
+# shared by every morphology call of the process
+KERNELS = KernelCache()
+
+
+def disk(radius):
+    return KERNELS.disk(int(radius))
+
+
+def offsets(radius):
+    return KERNELS.offsets(int(radius))
+
+
+def dilate(img, radius):
+    return si_morphology.binary_dilation(img, disk(radius))
+
+
+def closing(img, radius):
+    return si_morphology.binary_closing(img, disk(radius))
+
+
+def closing_stack(stack, radius):
+    # closing() of every plane of a (n, h, w) stack in one call, with the
+    # same border handling: the erosion sees True outside the image
+    if radius <= 0:
+        return(stack)
+    footprint = disk(radius)[np.newaxis]
+    dilated = sp_ndimage.binary_dilation(stack, footprint)
+    return sp_ndimage.binary_erosion(dilated, footprint, border_value=1)
+
+
+def ring(img, radius, distance=False):
+    # (ring, distance): the pixels within radius of img but not in it, which
+    # is dilate(img, radius) & ~img, and, if asked, their distance to img
+    # (0 outside the ring); the distance transform costs the same for any
+    # radius while a disk dilation grows with radius**2
+    img = img.astype(bool, copy=False)
+    shadow = np.zeros(img.shape, dtype=bool)
+    dist = np.zeros(img.shape) if distance else None
+    box = bounding_box(img)
+    if radius <= 0 or box is None:
+        return(shadow, dist)
+    if radius <= DILATE_RADIUS and not distance:
+        return(dilate(img, radius) & ~img, None)
+
+    # only the particles' bounding box grown by radius can be in the ring
+    h, w = img.shape
+    window = (slice(max(box[0] - radius, 0), min(box[1] + radius, h)),
+        slice(max(box[2] - radius, 0), min(box[3] + radius, w)))
+    local = img[window]
+    local_dist = sp_ndimage.distance_transform_edt(~local)
+    # distances are square roots of integers, exact where they equal radius
+    local_ring = (local_dist <= radius) & ~local
+    shadow[window] = local_ring
+    if distance:
+        dist[window] = np.where(local_ring, local_dist, 0)
+    return(shadow, dist)
+
+
+def kernel_stats():
+    return KERNELS.stats()
@@ -0,0 +1,90 @@
+"""Salt noise of particle masks, synthesised for runs of particles at once."""
+import numpy as np
+import scipy.ndimage as sp_ndimage
+
+from particle_simulation import morphology
+
+# particles synthesised by one vectorised call, bounds the scratch memory
+NOISE_BATCH = 256
+
+# 4-connected neighbours inside a plane of a stack, planes never touch
+PLANE_STRUCTURE = np.zeros([3, 3, 3], dtype=bool)
+PLANE_STRUCTURE[1] = sp_ndimage.generate_binary_structure(2, 1)
+
+
+def largest_components(stack):
+    # every plane of a (n, h, w) boolean stack reduced to its largest
+    # 4-connected component, the planes are labelled in one pass
+    labels, count = sp_ndimage.label(stack, PLANE_STRUCTURE)
+    if count == 0:
+        return(stack)
+    flat = labels.ravel()
+    sizes = np.bincount(flat)
+
+    # plane of every label, then the largest label of every plane
+    planes = np.zeros(count + 1, dtype=np.intp)
+    index = np.flatnonzero(flat)
+    planes[flat[index]] = index // (stack.shape[1]*stack.shape[2])
+    order = np.lexsort((sizes[1:], planes[1:])) + 1
+    last = np.append(planes[order][1:] != planes[order][:-1], True)
+
+    keep = np.zeros(count + 1, dtype=bool)
+    keep[order[last]] = True
+    return(keep[labels])
+
+
+def crop_planes(stack, y0, x0):
+    # (mask, y, x) of every plane cropped to its bounding box, y, x is the
+    # top left corner of the mask when the stack's corner is y0, x0
+    rows = stack.any(axis=2)
+    cols = stack.any(axis=1)
+    top = rows.argmax(axis=1)
+    bottom = rows.shape[1] - rows[:, ::-1].argmax(axis=1)
+    left = cols.argmax(axis=1)
+    right = cols.shape[1] - cols[:, ::-1].argmax(axis=1)
+
+    masks = []
+    for i, plane in enumerate(stack):
+        if not rows[i].any():
+            masks.append((plane[0:0, 0:0].copy(), y0, x0))
+            continue
+        # copied, a mask must not keep the whole stack alive
+        mask = plane[top[i]:bottom[i], left[i]:right[i]].copy()
+        masks.append((mask, y0 + int(top[i]), x0 + int(left[i])))
+    return(masks)
+
+
+def noisy_masks(rr, cc, half_y, half_x, noise_level, radius, count, generator, padding, pad):
+    # count noisy versions of the particle pixels rr, cc centered on half_y, half_x:
+    # salt is drawn on the whole noise window (padding half sizes around the
+    # center) outside the particle, as the single particle path drew it, not
+    # only near its border: salt reaching the particle through other salt
+    # stays attached; the particle keeps its largest component and is closed
+    # with a disk of radius; returns (mask, dy, dx) with dy, dx the offset of
+    # the mask's top left corner from the center
+    cy, cx = padding*half_y + pad, padding*half_x + pad
+    tile = np.zeros([2*cy, 2*cx], dtype=bool)
+    tile[rr - half_y + cy, cc - half_x + cx] = True
+
+    # pad free pixels around the window leave room for the closing
+    band = np.zeros(tile.shape, dtype=bool)
+    band[pad:2*cy - pad, pad:2*cx - pad] = True
+    band &= ~tile
+    band_index = np.flatnonzero(band)
+
+    # salt with skimage's random_noise(mode='salt') probability
+    amount = noise_level/2
+    masks = []
+    for start in range(0, count, NOISE_BATCH):
+        n = min(NOISE_BATCH, count - start)
+        stack = np.empty([n, tile.shape[0], tile.shape[1]], dtype=bool)
+        stack[:] = tile
+        flat = stack.reshape(n, -1)
+        if amount >= 1:
+            flat[:, band_index] = True
+        elif amount > 0:
+            flat[:, band_index] = generator.random((n, len(band_index))) <= amount
+        stack = largest_components(stack)
+        stack = morphology.closing_stack(stack, radius)
+        masks.extend(crop_planes(stack, -cy, -cx))
+    return(masks)
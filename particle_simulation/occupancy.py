@@ -0,0 +1,124 @@
+"""Occupancy index used to keep particles apart without full-frame tests."""
+import numpy as np
+
+from particle_simulation import morphology
+
+# up to this many scattered pixels the disk offsets grow a mask faster than a dilation
+SCATTER_PIXELS = 32768
+
+
+class OccupancyGrid(object):
+    def __init__(self, img, margin=5, cell=32):
+        # img is the binary image the particles are drawn on, add() updates it in place
+        # margin is the free distance kept around every particle
+        # cell is the size of the coarse cells used to skip empty regions
+        self.img = img
+        self.margin = margin
+        self.cell = cell
+        h, w = img.shape
+        self.counts = np.zeros([-(-h//cell), -(-w//cell)], dtype=int)
+
+    def window(self, y0, x0, mh, mw):
+        # slices of the image and of a (mh, mw) mask placed at (y0, x0),
+        # clipped to the image border, None if they don't overlap
+        h, w = self.img.shape
+        y_start, x_start = max(y0, 0), max(x0, 0)
+        y_stop, x_stop = min(y0 + mh, h), min(x0 + mw, w)
+        if y_start >= y_stop or x_start >= x_stop:
+            return None
+        img_slice = (slice(y_start, y_stop), slice(x_start, x_stop))
+        mask_slice = (slice(y_start - y0, y_stop - y0), slice(x_start - x0, x_stop - x0))
+        return(img_slice, mask_slice)
+
+    def cells(self, img_slice):
+        # coarse cells covered by an image window
+        rows, cols = img_slice
+        c = self.cell
+        return(slice(rows.start//c, (rows.stop - 1)//c + 1), slice(cols.start//c, (cols.stop - 1)//c + 1))
+
+    def hits(self, rr, cc):
+        # True if any of the pixels rr, cc is already occupied
+        if len(rr) == 0:
+            return False
+        if not self.counts[rr//self.cell, cc//self.cell].any():
+            return False
+        return bool(self.img[rr, cc].any())
+
+    def collides(self, mask, y0, x0, footprint=None):
+        # True if mask, with its top left corner at (y0, x0), comes closer
+        # than margin pixels to an occupied pixel
+        # footprint is the mask already grown by the margin, if known
+        m = self.margin
+        mh, mw = mask.shape
+        found = self.window(y0 - m, x0 - m, mh + 2*m, mw + 2*m)
+        if found is None or not mask.any():
+            return False
+        img_slice, grown_slice = found
+        if not self.counts[self.cells(img_slice)].any():
+            return False
+
+        if footprint is not None:
+            grown = footprint
+        else:
+            rows, cols = np.nonzero(mask)
+            dr, dc = morphology.offsets(m)
+            grown = np.zeros([mh + 2*m, mw + 2*m], dtype=bool)
+            if len(rows)*len(dr) <= SCATTER_PIXELS:
+                # dilate(mask, m) as a scatter of the disk offsets around every pixel
+                grown[(rows[:, None] + dr + m).ravel(), (cols[:, None] + dc + m).ravel()] = True
+            else:
+                grown[m:m + mh, m:m + mw] = mask
+                grown = morphology.dilate(grown, m)
+        return bool(self.img[img_slice][grown[grown_slice]].any())
+
+    def add(self, mask, y0, x0):
+        # draw mask with its top left corner at (y0, x0) and index it
+        found = self.window(y0, x0, mask.shape[0], mask.shape[1])
+        if found is None:
+            return
+        img_slice, mask_slice = found
+        mask = mask[mask_slice].astype(bool, copy=False)
+        if not mask.any():
+            return
+        self.img[img_slice][mask] = 1
+        self.counts[self.cells(img_slice)] += 1
+
+    def remove(self, mask, y0, x0):
+        # undo add(mask, y0, x0): its pixels are cleared, the caller draws
+        # the pixels of the particles overlapping it again
+        found = self.window(y0, x0, mask.shape[0], mask.shape[1])
+        if found is None:
+            return
+        img_slice, mask_slice = found
+        mask = mask[mask_slice].astype(bool, copy=False)
+        if not mask.any():
+            return
+        self.img[img_slice][mask] = 0
+        cells = self.cells(img_slice)
+        self.counts[cells] = np.maximum(self.counts[cells] - 1, 0)
+
+    def add_many(self, mask, y0, x0):
+        # draw the same mask at every (y0[i], x0[i]) in one scatter and index them
+        if len(y0) == 0:
+            return
+        h, w = self.img.shape
+        mh, mw = mask.shape
+        dy, dx = np.nonzero(mask)
+        rows = y0[:, None] + dy[None, :]
+        cols = x0[:, None] + dx[None, :]
+        inside = (rows >= 0) & (rows < h) & (cols >= 0) & (cols < w)
+        self.img[rows[inside], cols[inside]] = 1
+
+        # bounding boxes clipped to the image, in cells
+        visible = inside.any(axis=1)
+        c = self.cell
+        cy0 = np.clip(y0[visible], 0, h - 1)//c
+        cy1 = np.clip(y0[visible] + mh - 1, 0, h - 1)//c
+        cx0 = np.clip(x0[visible], 0, w - 1)//c
+        cx1 = np.clip(x0[visible] + mw - 1, 0, w - 1)//c
+        if len(cy0) == 0:
+            return
+        for i in range((cy1 - cy0).max() + 1):
+            for j in range((cx1 - cx0).max() + 1):
+                sel = (cy0 + i <= cy1) & (cx0 + j <= cx1)
+                np.add.at(self.counts, (cy0[sel] + i, cx0[sel] + j), 1)
@@ -0,0 +1,87 @@
+"""Optional per-stage timing of the generation pipeline."""
+import contextlib
+import json
+import time
+import tracemalloc
+
+# used by the generator when it isn't profiled
+NULL_STAGE = contextlib.nullcontext()
+
+
+class StageProfiler(object):
+    def __init__(self, trace_allocations=False):
+        # trace_allocations records the peak memory allocated in every stage
+        # with tracemalloc, which slows the pipeline down noticeably; tracing
+        # is started for the outermost stages when it isn't on already
+        self.trace_allocations = trace_allocations
+        self.reset()
+
+    def reset(self):
+        # called by generate_images, a report covers one image
+        self.stages = {}
+        self.attempt_counts = {}
+        self.counters = {}
+        self.open = []
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # time the with block, nested stages are included in their parent's time
+        tracing = self.trace_allocations
+        started = tracing and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        entry = {'peak': 0}
+        if tracing:
+            entry['memory'] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.open.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.open.pop()
+            stats = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_bytes': 0})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            if tracing:
+                # inner stages reset the peak, their peaks are carried up
+                peak = max(tracemalloc.get_traced_memory()[1], entry['peak'])
+                stats['peak_bytes'] = max(stats['peak_bytes'], peak - entry['memory'])
+                if self.open:
+                    self.open[-1]['peak'] = max(self.open[-1]['peak'], peak)
+            if started:
+                tracemalloc.stop()
+
+    def attempts(self, tries, n=1):
+        # placement attempts n particles needed
+        self.attempt_counts[tries] = self.attempt_counts.get(tries, 0) + n
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        # plain dict, ready for json
+        return {'total_seconds': time.perf_counter() - self.start,
+            'stages': {name: dict(stats) for name, stats in self.stages.items()},
+            'attempts': {str(k): self.attempt_counts[k] for k in sorted(self.attempt_counts)},
+            'counters': dict(self.counters)}
+
+    def save(self, file_name):
+        save_reports(file_name, [self.report()])
+
+
+def save_reports(file_name, reports):
+    with open(file_name, 'w') as f:
+        json.dump(reports, f, indent=1)
+
+
+def summary_rows(report):
+    # (stage, calls, seconds, share of the image time, peak MB) by decreasing time
+    total = report['total_seconds'] or 1.0
+    rows = []
+    for name, stats in sorted(report['stages'].items(), key=lambda item: -item[1]['seconds']):
+        rows.append((name, stats['calls'], stats['seconds'], stats['seconds']/total,
+            stats['peak_bytes']/2**20))
+    return rows
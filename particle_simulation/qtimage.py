@@ -0,0 +1,19 @@
+"""NumPy arrays to QImage/QPixmap without going through image files."""
+import numpy as np
+from qtpy import QtGui
+
+from particle_simulation.convert import to_uint8
+
+
+def array2qimage(img):
+    # 8 bit gray QImage reading the array's buffer, uint8 arrays aren't copied
+    data = np.ascontiguousarray(to_uint8(img))
+    h, w = data.shape
+    qimage = QtGui.QImage(data.data, w, h, data.strides[0], QtGui.QImage.Format_Grayscale8)
+    # QImage doesn't own the buffer, keep it alive with the image
+    qimage.ndarray = data
+    return qimage
+
+
+def array2pixmap(img):
+    return QtGui.QPixmap.fromImage(array2qimage(img))
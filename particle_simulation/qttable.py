@@ -0,0 +1,55 @@
+"""Qt model of the particle table, read straight from its columns."""
+from qtpy import QtCore
+
+from particle_simulation.engine import PARTICLE_SHAPES
+
+HEADERS = ['Shape', 'Size', 'Noise', 'Rotation']
+
+
+class ParticleTableModel(QtCore.QAbstractTableModel):
+    def __init__(self, table, parent=None):
+        # table is a ParticleTable, change it through the model so views follow
+        super(ParticleTableModel, self).__init__(parent)
+        self.table = table
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.table)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(HEADERS)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole or not index.isValid():
+            return None
+        row, column = index.row(), index.column()
+        if column == 0:
+            return PARTICLE_SHAPES[self.table.column('shape')[row]]
+        if column == 1:
+            return str(self.table.size_value(row))
+        if column == 2:
+            return str(float(self.table.column('noise')[row]))
+        return str(int(self.table.column('rotation')[row]))
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return HEADERS[section]
+        return super(ParticleTableModel, self).headerData(section, orientation, role)
+
+    def append(self, particles):
+        if len(particles) == 0:
+            return
+        start = len(self.table)
+        self.beginInsertRows(QtCore.QModelIndex(), start, start + len(particles) - 1)
+        self.table.append(particles)
+        self.endInsertRows()
+
+    def delete(self, rows):
+        # any set of rows in one pass, the views are reset once
+        self.beginResetModel()
+        self.table.delete(rows)
+        self.endResetModel()
+
+    def replace(self, rows, particle):
+        self.table.replace(rows, particle)
+        if len(rows):
+            self.dataChanged.emit(self.index(min(rows), 0), self.index(max(rows), len(HEADERS) - 1))
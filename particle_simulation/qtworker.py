@@ -0,0 +1,136 @@
+"""Run the generator on a QThread, away from the Qt event loop."""
+import threading
+
+from qtpy import QtCore
+
+from particle_simulation.dataset import generate_dataset
+from particle_simulation.engine import GenerationCancelled
+
+
+class GenerationWorker(QtCore.QObject):
+    # placed particles, total particles, placement retries
+    progress = QtCore.Signal(int, int, int)
+    # dict of images, the generator's arrays themselves
+    done = QtCore.Signal(object)
+    cancelled = QtCore.Signal()
+    failed = QtCore.Signal(str)
+    # placement rules were dropped, the generator keeps going without them
+    rules_dropped = QtCore.Signal()
+
+    def __init__(self, generator, particles):
+        # generator is a ParticleGenerator or a Scene
+        super(GenerationWorker, self).__init__()
+        self.generator = generator
+        self.particles = particles
+        # the token of the image this worker generates, made before it runs
+        self.token = generator.cancel_token()
+        generator.on_progress = self.progress.emit
+        generator.on_no_rules = self.rules_dropped.emit
+
+    def run(self):
+        try:
+            images = self.generator.generate_images(self.particles)
+        except GenerationCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.done.emit(images)
+
+    def cancel(self):
+        self.token.set()
+
+
+class DatasetWorker(QtCore.QObject):
+    # images saved, images to save, file name of the last one
+    progress = QtCore.Signal(int, int, str)
+    # file names of the saved images
+    done = QtCore.Signal(object)
+    cancelled = QtCore.Signal()
+    failed = QtCore.Signal(str)
+
+    def __init__(self, config, count, out_dir, **options):
+        # runs generate_dataset(config, count, out_dir, **options), a cancel
+        # stops it once the image being saved is written
+        super(DatasetWorker, self).__init__()
+        self.config = config
+        self.count = count
+        self.out_dir = out_dir
+        self.options = options
+        self.cancel_requested = False
+
+    def run(self):
+        try:
+            file_names = generate_dataset(self.config, self.count, self.out_dir,
+                callback=self.saved, **self.options)
+        except GenerationCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.done.emit(file_names)
+
+    def saved(self, done, count, file_name):
+        if self.cancel_requested:
+            raise GenerationCancelled()
+        self.progress.emit(done, count, file_name)
+
+    def cancel(self):
+        self.cancel_requested = True
+
+
+class PreviewWorker(QtCore.QObject):
+    # request id, particle with its binary mask
+    done = QtCore.Signal(int, object)
+    failed = QtCore.Signal(int, str)
+    wake = QtCore.Signal()
+
+    def __init__(self, generator):
+        # draws editor particles with generator.preview_particle, only the
+        # latest request is drawn, the ones it replaced before it started are dropped
+        super(PreviewWorker, self).__init__()
+        self.generator = generator
+        self.lock = threading.Lock()
+        self.pending = None
+        self.wake.connect(self.run)
+
+    def request(self, request_id, *args):
+        # called from the GUI thread, args of preview_particle
+        with self.lock:
+            self.pending = (request_id, args)
+        self.wake.emit()
+
+    @QtCore.Slot()
+    def run(self):
+        with self.lock:
+            job, self.pending = self.pending, None
+        if job is None:
+            # already drawn by an earlier wake up
+            return
+        request_id, args = job
+        try:
+            particle = self.generator.preview_particle(*args)
+        except Exception as e:
+            self.failed.emit(request_id, str(e))
+        else:
+            self.done.emit(request_id, particle)
+
+
+def start_worker(worker):
+    # move worker to a new thread and start it, the thread ends with the worker
+    thread = QtCore.QThread()
+    worker.moveToThread(thread)
+    thread.started.connect(worker.run)
+    # quit is called from the worker thread, a GUI thread blocked in wait() still sees the end
+    for signal in [worker.done, worker.cancelled, worker.failed]:
+        signal.connect(thread.quit, QtCore.Qt.DirectConnection)
+    thread.start()
+    return thread
+
+
+def start_preview_worker(worker):
+    # move worker to a thread of its own, running until it is quit
+    thread = QtCore.QThread()
+    worker.moveToThread(thread)
+    thread.start()
+    return thread
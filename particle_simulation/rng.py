@@ -0,0 +1,45 @@
+"""Random number service shared by the generation pipeline."""
+import numpy as np
+
+# uniform numbers drawn at once for the scalar draws
+BLOCK = 4096
+
+
+class RandomSource(object):
+    def __init__(self, seed=None, block=BLOCK):
+        # seed is an int, a np.random.SeedSequence or None for a fresh one;
+        # the sequence is kept so that an unseeded run can be replayed
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed = seed
+        self.generator = np.random.default_rng(seed)
+        self.block = block
+        self.uniform = np.zeros(0)
+        self.pos = 0
+
+    def next_uniform(self):
+        # next pre-drawn number in [0, 1), the block is refilled when used up
+        if self.pos >= len(self.uniform):
+            self.uniform = self.generator.random(self.block)
+            self.pos = 0
+        u = self.uniform[self.pos]
+        self.pos += 1
+        return u
+
+    def randint(self, low, high):
+        # one integer in [low, high) in constant time
+        if high <= low:
+            raise ValueError('Empty range: [' + str(low) + ', ' + str(high) + ')')
+        return low + min(int(self.next_uniform()*(high - low)), high - low - 1)
+
+    def rand(self, mn, mx, step=1):
+        # one element of np.arange(mn, mx, step) without building the range
+        count = int(np.ceil((mx - mn)/step))
+        return mn + step*self.randint(0, count)
+
+    def integers(self, low, high, size=None):
+        # many draws at once go straight to the generator
+        return self.generator.integers(low, high, size=size)
+
+    def choice(self, a, size=None, replace=True):
+        return self.generator.choice(a, size=size, replace=replace)
@@ -0,0 +1,296 @@
+"""Placed particles and cached image layers, re-rendered only where they change."""
+import numpy as np
+
+from particle_simulation.engine import ParticleGenerator, default_config
+from particle_simulation.tiled import GAUSSIAN_TRUNCATE
+
+# config keys whose change places every particle again
+PLACEMENT_KEYS = ['width', 'height', 'dtype', 'not_edge', 'not_attach', 'hold_particle']
+
+# cached layers in pipeline order and the config keys each one is computed from
+LAYER_KEYS = [('background', ['background']), ('shadow', ['shadow', 'shadow_falloff']),
+    ('composite', ['contrast']), ('blur', ['gaussian'])]
+
+# dirty regions covering more of the frame than this are rendered as one full frame
+FULL_FRAME_SHARE = 0.5
+
+
+def grow(box, n, h, w):
+    # (y0, y1, x0, x1) box grown by n pixels, clipped to the h x w frame
+    y0, y1, x0, x1 = box
+    return(max(y0 - n, 0), min(y1 + n, h), max(x0 - n, 0), min(x1 + n, w))
+
+
+def box_slice(box, origin=(0, 0)):
+    # slices of box in an image whose top left corner is origin
+    y0, y1, x0, x1 = box
+    return(slice(y0 - origin[0], y1 - origin[0]), slice(x0 - origin[1], x1 - origin[1]))
+
+
+def particle_key(particle):
+    # identity of a particle across images: its table uid, or the dict itself
+    return particle.get('uid', id(particle))
+
+
+def particle_boxes(particles):
+    # (n, 4) array of the (y0, y1, x0, x1) frame boxes of placed particles
+    boxes = np.zeros([len(particles), 4], dtype=int)
+    for i, particle in enumerate(particles):
+        y0, x0 = particle['position']['y'], particle['position']['x']
+        mh, mw = particle['binary'].shape
+        boxes[i] = [y0, y0 + mh, x0, x0 + mw]
+    return(boxes)
+
+
+class Scene(object):
+    def __init__(self, config=None, seed=None, on_no_rules=None, on_progress=None, profiler=None):
+        # the particles stay where they were placed and every layer of the
+        # last image is kept; generate_images only recomputes the layers and
+        # regions reached by what changed since, a particle or a config value
+        self.generator = ParticleGenerator(config, seed=seed, profiler=profiler)
+        self.seed = self.generator.rng.seed
+        self.on_no_rules = on_no_rules
+        self.on_progress = on_progress
+        self.configure(config)
+
+        # binary, background, shadow (ring), weight (shadow strength, None when
+        # uniform), composite and blur (None without blur) of the last image
+        self.layers = None
+        # config the layers were rendered with, None when they are out of date
+        self.rendered = None
+        self.particles = []
+        # particle_key of every placed particle to its dict
+        self.index = {}
+        self.boxes = np.zeros([0, 4], dtype=int)
+
+        # rng state before the background noise, redrawn from there
+        self.background_state = None
+        self.initial_state = self.generator.rng.generator.bit_generator.state
+        # True while the image is the one scene_manifest(config, seed, particles) replays
+        self.replayable = False
+
+    def configure(self, config):
+        # config of the next generate_images
+        self.config = default_config()
+        if config is not None:
+            self.config.update(config)
+
+    def updatable(self, config, particles):
+        # True if the image can be brought up to date with config and particles
+        # without placing every particle again, and something did change
+        if self.rendered is None:
+            return False
+        full = default_config()
+        full.update(config)
+        if any(full[key] != self.rendered[key] for key in PLACEMENT_KEYS):
+            return False
+        if [particle_key(p) for p in particles] != [particle_key(p) for p in self.particles]:
+            return True
+        return any(full[key] != self.rendered[key] for name, keys in LAYER_KEYS for key in keys)
+
+    def generate_images(self, particles):
+        # same images as ParticleGenerator.generate_images, from the cache when it can
+        generator = self.generator
+        generator.on_progress = self.on_progress
+        generator.on_no_rules = self.on_no_rules
+        generator.retries = 0
+        # placement rules dropped by the last image are back
+        generator.config.update(self.config)
+        if generator.profiler is not None:
+            generator.profiler.reset()
+
+        try:
+            if self.rendered is None or any(self.config[key] != self.rendered[key]
+                    for key in PLACEMENT_KEYS):
+                self.build(particles)
+            else:
+                self.update(particles)
+        except BaseException:
+            # half updated layers are of no use to the next image
+            self.rendered = None
+            raise
+        finally:
+            generator.end_run()
+        self.rendered = dict(self.config)
+        return(self.images())
+
+    def build(self, particles):
+        generator = self.generator
+        # held particles keep masks drawn for an earlier image, the seed does not redraw them
+        self.replayable = (generator.rng.generator.bit_generator.state == self.initial_state
+            and not self.config['hold_particle'])
+        binary = generator.place_frame(particles)
+        self.background_state = generator.rng.generator.bit_generator.state
+        self.layers = {'binary': binary, 'background': generator.background_image()}
+        self.particles = list(particles)
+        self.index = {particle_key(p): p for p in self.particles}
+        self.boxes = particle_boxes(self.particles)
+        self.render_layers(0, [])
+
+    def update(self, particles):
+        current = set(particle_key(p) for p in particles)
+        removed = [i for i, p in enumerate(self.particles) if particle_key(p) not in current]
+        added = [p for p in particles if particle_key(p) not in self.index]
+        dirty = self.remove_particles(removed) + self.add_particles(added)
+        self.particles = list(particles)
+        self.index = {particle_key(p): p for p in self.particles}
+        self.boxes = particle_boxes(self.particles)
+        if dirty:
+            # the placements differ from the ones the seed replays
+            self.replayable = False
+        if self.generator.profiler is not None:
+            self.generator.profiler.count('dirty_regions', len(dirty))
+
+        # first layer whose config changed, it and the layers after it are
+        # rendered on the full frame, the ones before only on the dirty regions
+        first = len(LAYER_KEYS)
+        for i, (name, keys) in enumerate(LAYER_KEYS):
+            if any(self.config[key] != self.rendered[key] for key in keys):
+                first = i
+                break
+        if first == 0:
+            # same noise as the first image would have drawn with this intensity
+            self.generator.rng.generator.bit_generator.state = self.background_state
+            self.layers['background'] = self.generator.background_image()
+        self.render_layers(max(first, 1), dirty)
+
+    def remove_particles(self, indexes):
+        # take the particles at indexes off the binary image, returns their boxes
+        if len(indexes) == 0:
+            return []
+        binary = self.layers['binary']
+        h, w = binary.shape
+        occupancy = self.generator.get_occupancy(binary)
+        with self.generator.stage('remove'):
+            boxes = []
+            for i in indexes:
+                particle = self.particles[i]
+                occupancy.remove(particle['binary'], particle['position']['y'],
+                    particle['position']['x'])
+                boxes.append(grow(self.boxes[i], 0, h, w))
+
+            # pixels shared with the particles left are drawn again
+            keep = np.ones(len(self.particles), dtype=bool)
+            keep[indexes] = False
+            for box in boxes:
+                self.restamp(box, keep)
+        return([box for box in boxes if box[0] < box[1] and box[2] < box[3]])
+
+    def restamp(self, box, keep):
+        # draw the kept particles overlapping box again, inside box
+        y0, y1, x0, x1 = box
+        b = self.boxes
+        near = keep & (b[:, 0] < y1) & (b[:, 1] > y0) & (b[:, 2] < x1) & (b[:, 3] > x0)
+        binary = self.layers['binary']
+        for i in np.nonzero(near)[0]:
+            rows = slice(max(b[i, 0], y0), min(b[i, 1], y1))
+            cols = slice(max(b[i, 2], x0), min(b[i, 3], x1))
+            binary[rows, cols] |= self.particles[i]['binary'][rows.start - b[i, 0]:rows.stop - b[i, 0],
+                cols.start - b[i, 2]:cols.stop - b[i, 2]].astype(bool, copy=False)
+
+    def add_particles(self, particles):
+        # place new particles among the ones already placed, returns their boxes
+        if len(particles) == 0:
+            return []
+        binary = self.layers['binary']
+        h, w = binary.shape
+        with self.generator.stage('placement'):
+            self.generator.place_particles(particles, binary)
+        boxes = [grow(box, 0, h, w) for box in particle_boxes(particles)]
+        return([box for box in boxes if box[0] < box[1] and box[2] < box[3]])
+
+    def render_layers(self, first, dirty):
+        # shadow, composite and blur layers: full frame from LAYER_KEYS index
+        # first on, over the dirty regions before
+        h, w = self.layers['binary'].shape
+        full = (0, h, 0, w)
+        for i, (name, keys) in enumerate(LAYER_KEYS[1:]):
+            if i + 1 >= first or self.layers.get(name) is None:
+                boxes = [full]
+            elif sum((b[1] - b[0])*(b[3] - b[2]) for b in dirty) > FULL_FRAME_SHARE*h*w:
+                boxes = [full]
+            else:
+                boxes = dirty
+            for box in boxes:
+                self.generator.check_cancel()
+                getattr(self, 'render_' + name)(box, box == full)
+
+    def shadow_reach(self):
+        # pixels a binary change reaches through the shadow
+        if self.config['shadow'] == 0:
+            return(0)
+        return(self.generator.shadow_radius())
+
+    def render_shadow(self, box, full=False):
+        layers = self.layers
+        binary = layers['binary']
+        h, w = binary.shape
+        if full:
+            layers['shadow'] = np.zeros(binary.shape, dtype=bool)
+            layers['weight'] = None
+            if self.config['shadow'] == 0:
+                return
+            if self.config['shadow_falloff'] != 'hard':
+                layers['weight'] = np.zeros(binary.shape, dtype=self.config['dtype'])
+        elif self.config['shadow'] == 0:
+            return
+
+        # the ring of a pixel only depends on the particles within radius of it
+        r = self.shadow_reach()
+        target = grow(box, r, h, w)
+        source = grow(box, 2*r, h, w)
+        crop = box_slice(target, source[::2])
+        with self.generator.stage('shadow'):
+            ring, weight = self.generator.shadow(binary[box_slice(source)])
+            layers['shadow'][box_slice(target)] = ring[crop]
+            if weight is not None:
+                strength = np.zeros(ring.shape, dtype=weight.dtype)
+                strength[ring] = weight
+                layers['weight'][box_slice(target)] = strength[crop]
+
+    def render_composite(self, box, full=False):
+        layers = self.layers
+        h, w = layers['binary'].shape
+        target = box_slice(grow(box, self.shadow_reach(), h, w))
+        ring = layers['shadow'][target]
+        weight = None
+        if layers['weight'] is not None:
+            weight = layers['weight'][target][ring]
+        with self.generator.stage('composite'):
+            composite = self.generator.composite(layers['binary'][target],
+                layers['background'][target], ring, weight)
+        if full:
+            layers['composite'] = composite
+        else:
+            layers['composite'][target] = composite
+
+    def render_blur(self, box, full=False):
+        layers = self.layers
+        sigma = self.config['gaussian']
+        if sigma <= 0:
+            layers['blur'] = None
+            return
+        if full:
+            layers['blur'] = self.generator.blur(layers['composite'])
+            return
+
+        # a blurred pixel reads the composite up to GAUSSIAN_TRUNCATE sigma away
+        h, w = layers['binary'].shape
+        g = int(np.ceil(GAUSSIAN_TRUNCATE*sigma)) + 1
+        target = grow(box, self.shadow_reach() + g, h, w)
+        source = grow(target, g, h, w)
+        blurred = self.generator.blur(layers['composite'][box_slice(source)])
+        layers['blur'][box_slice(target)] = blurred[box_slice(target, source[::2])]
+
+    def images(self):
+        # the layers themselves, updated in place by the next generate_images
+        layers = self.layers
+        particle_bkg = layers['blur'] if layers['blur'] is not None else layers['composite']
+        return {'binary_image': layers['binary'], 'bkg_image': layers['background'],
+            'particle_bkg_image': particle_bkg}
+
+    def cancel(self):
+        self.generator.cancel()
+
+    def cancel_token(self):
+        return self.generator.cancel_token()
@@ -0,0 +1,223 @@
+"""Chunked, memory-mappable store of images, masks and particle labels."""
+import json
+import os
+
+import numpy as np
+
+from particle_simulation.engine import PARTICLE_SHAPES
+
+# images per chunk file
+CHUNK = 256
+
+INDEX_FILE = 'index.json'
+
+# one row per particle, rows of an image are contiguous and in drawing order
+PARTICLE_DTYPE = np.dtype([
+    ('image', np.int64),     # index of the image in the store
+    ('label', np.int32),     # value of the particle in the instance mask
+    ('shape', np.int8),      # index in PARTICLE_SHAPES
+    ('size', np.float32),    # size, major axis of ellipses
+    ('minor', np.float32),   # minor axis of ellipses, size otherwise
+    ('noise', np.float32),
+    ('rotation', np.float32),
+    ('y0', np.int32),        # top left corner of the mask in the image
+    ('x0', np.int32),
+    ('height', np.int32),    # size of the mask
+    ('width', np.int32),
+    ('center_y', np.int32),
+    ('center_x', np.int32),
+    ('area', np.int32),      # pixels of the mask, before clipping to the image
+])
+
+
+def split_size(size):
+    # (size, minor) of a particle, ellipse sizes are given as 'major;minor'
+    if isinstance(size, str):
+        major, minor = [float(i) for i in size.split(';')]
+        return(major, minor)
+    return(float(size), float(size))
+
+
+def particle_table(particles, image=0):
+    # PARTICLE_DTYPE rows of the particles drawn on an image
+    table = np.zeros(len(particles), dtype=PARTICLE_DTYPE)
+    for i, particle in enumerate(particles):
+        size, minor = split_size(particle['size'])
+        mask = particle['binary']
+        table[i] = (image, i + 1, PARTICLE_SHAPES.index(particle['shape']), size, minor,
+            particle['noise'], particle['rotation'],
+            particle['position']['y'], particle['position']['x'], mask.shape[0], mask.shape[1],
+            particle['center']['y'], particle['center']['x'], np.count_nonzero(mask))
+    return(table)
+
+
+def instance_mask(particles, shape):
+    # label image, pixel i + 1 belongs to particles[i], later particles
+    # are drawn over earlier ones where they overlap
+    labels = np.zeros(shape, dtype=np.uint16 if len(particles) < 2**16 else np.uint32)
+    h, w = shape
+    for i, particle in enumerate(particles):
+        mask = particle['binary'].astype(bool, copy=False)
+        y0, x0 = particle['position']['y'], particle['position']['x']
+        y_start, x_start = max(y0, 0), max(x0, 0)
+        y_stop, x_stop = min(y0 + mask.shape[0], h), min(x0 + mask.shape[1], w)
+        if y_start >= y_stop or x_start >= x_stop:
+            continue
+        crop = mask[y_start - y0:y_stop - y0, x_start - x0:x_stop - x0]
+        labels[y_start:y_stop, x_start:x_stop][crop] = i + 1
+    return(labels)
+
+
+class DatasetStore(object):
+    def __init__(self, path, mode='r'):
+        # open the store written in directory path, mode is 'r' or 'r+';
+        # use DatasetStore.create for a new store
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.chunks = {}
+        self.tables = {}
+        # rows written since the store was opened, kept in memory until close()
+        self.pending = None if mode == 'r' else {}
+
+    @classmethod
+    def create(cls, path, height, width, chunk=CHUNK, image_dtype='uint8', config=None):
+        # empty store of height x width images; image_dtype is uint8 for the
+        # png values or float32 for the raw intensities
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        index = {'count': 0, 'height': height, 'width': width, 'chunk': chunk,
+            'image_dtype': np.dtype(image_dtype).name, 'chunks': 0, 'config': config}
+        with open(os.path.join(path, INDEX_FILE), 'w') as f:
+            json.dump(index, f, indent=1)
+        return cls(path, mode='r+')
+
+    def __len__(self):
+        return self.index['count']
+
+    def chunk_file(self, chunk, name):
+        return os.path.join(self.path, 'chunk_%05d_%s.npy' % (chunk, name))
+
+    def chunk_arrays(self, chunk):
+        # (images, masks) memmaps of a chunk, opened once
+        if chunk not in self.chunks:
+            mode = 'r' if self.mode == 'r' else 'r+'
+            self.chunks[chunk] = (np.load(self.chunk_file(chunk, 'images'), mmap_mode=mode),
+                np.load(self.chunk_file(chunk, 'masks'), mmap_mode=mode))
+        return self.chunks[chunk]
+
+    def chunk_table(self, chunk):
+        # (particles, offsets) of a chunk, opened once; the rows of its j-th
+        # image are particles[offsets[j]:offsets[j + 1]]
+        if chunk not in self.tables:
+            self.tables[chunk] = (np.load(self.chunk_file(chunk, 'particles'), mmap_mode='r'),
+                np.load(self.chunk_file(chunk, 'offsets')))
+        return self.tables[chunk]
+
+    def resize(self, count):
+        # make room for count images, whole chunks are allocated at once
+        index = self.index
+        shape = (index['chunk'], index['height'], index['width'])
+        while index['chunks']*index['chunk'] < count:
+            chunk = index['chunks']
+            np.lib.format.open_memmap(self.chunk_file(chunk, 'images'), mode='w+',
+                dtype=index['image_dtype'], shape=shape).flush()
+            np.lib.format.open_memmap(self.chunk_file(chunk, 'masks'), mode='w+',
+                dtype=np.uint16, shape=shape).flush()
+            np.save(self.chunk_file(chunk, 'particles'), np.zeros(0, dtype=PARTICLE_DTYPE))
+            np.save(self.chunk_file(chunk, 'offsets'), np.zeros(index['chunk'] + 1, dtype=np.int64))
+            index['chunks'] += 1
+        index['count'] = max(index['count'], count)
+
+    def write(self, i, image, mask, particles):
+        # image i, its instance mask and its PARTICLE_DTYPE rows
+        if self.mode == 'r':
+            raise IOError('Store opened read only: ' + self.path)
+        shape = (self.index['height'], self.index['width'])
+        if np.shape(image) != shape or np.shape(mask) != shape:
+            raise ValueError('Image ' + str(i) + ' is ' + str(np.shape(image)) + ', the store holds '
+                + str(shape) + ' images')
+        if i >= len(self):
+            self.resize(i + 1)
+        if len(particles) >= 2**16:
+            raise ValueError('Instance masks are 16 bit, image ' + str(i) + ' has '
+                + str(len(particles)) + ' particles')
+        images, masks = self.chunk_arrays(i//self.index['chunk'])
+        images[i % self.index['chunk']] = image
+        masks[i % self.index['chunk']] = mask
+        particles = np.array(particles, dtype=PARTICLE_DTYPE)
+        particles['image'] = i
+        self.pending[i] = particles
+
+    def append(self, image, mask, particles):
+        self.write(len(self), image, mask, particles)
+        return len(self) - 1
+
+    def image_particles(self, i):
+        if self.pending is not None and i in self.pending:
+            return self.pending[i]
+        particles, offsets = self.chunk_table(i//self.index['chunk'])
+        j = i % self.index['chunk']
+        return particles[offsets[j]:offsets[j + 1]]
+
+    def __getitem__(self, i):
+        # {'image', 'mask', 'particles'} of image i, read from the memmaps
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Image ' + str(i) + ' not in a store of ' + str(len(self)))
+        images, masks = self.chunk_arrays(i//self.index['chunk'])
+        return {'image': images[i % self.index['chunk']], 'mask': masks[i % self.index['chunk']],
+            'particles': self.image_particles(i)}
+
+    def write_table(self, chunk):
+        # rewrite the particle rows of a chunk with its pending images
+        size = self.index['chunk']
+        first = chunk*size
+        tables = [np.array(self.image_particles(i)) for i in range(first, first + size)]
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(t) for t in tables])
+        self.tables.pop(chunk, None)
+        np.save(self.chunk_file(chunk, 'particles'),
+            np.concatenate([np.zeros(0, dtype=PARTICLE_DTYPE)] + tables))
+        np.save(self.chunk_file(chunk, 'offsets'), offsets)
+
+    def close(self):
+        # flush the chunks and write the particle rows and the index; only
+        # the chunks images were written to are touched
+        for images, masks in self.chunks.values():
+            if self.mode != 'r':
+                images.flush()
+                masks.flush()
+        self.chunks = {}
+        if self.mode == 'r':
+            return
+        for chunk in sorted(set(i//self.index['chunk'] for i in self.pending)):
+            self.write_table(chunk)
+        with open(os.path.join(self.path, INDEX_FILE), 'w') as f:
+            json.dump(self.index, f, indent=1)
+        self.mode = 'r'
+        self.pending = None
+
+    def discard(self):
+        # close without writing the particle rows and the index: the store
+        # keeps the images it had when it was opened
+        self.chunks = {}
+        self.tables = {}
+        if self.mode == 'r':
+            return
+        with open(os.path.join(self.path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.mode = 'r'
+        self.pending = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # an exception drops what was written since the store was opened
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
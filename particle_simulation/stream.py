@@ -0,0 +1,126 @@
+"""Lazy stream of freshly generated samples for training loops."""
+import collections
+import multiprocessing
+
+import numpy as np
+
+from particle_simulation.annotations import coco_annotations
+from particle_simulation.convert import to_uint8
+from particle_simulation.dataset import IMAGE_TYPES, root_seed
+from particle_simulation.engine import ParticleGenerator
+from particle_simulation.store import instance_mask, particle_table
+
+# samples rendered ahead of the consumer
+PREFETCH = 8
+
+# records: PARTICLE_DTYPE rows, coco: a COCO style dict, None: no annotations
+STREAM_ANNOTATIONS = ['records', 'coco', None]
+
+
+def child_seed(root, index):
+    # seed of image index, the one generate_dataset gives it for the same seed
+    return np.random.SeedSequence(root.entropy, spawn_key=tuple(root.spawn_key) + (index,))
+
+
+def make_sample(job):
+    # worker entry point: (image, instance mask, annotations) of one image
+    index, config, seed, image_type, image_dtype, annotations = job
+    generator = ParticleGenerator(config, seed=seed)
+    images = generator.generate_images()
+    img = images[image_type]
+    if image_dtype is not None:
+        img = to_uint8(img) if np.dtype(image_dtype) == np.uint8 else img.astype(image_dtype)
+    mask = instance_mask(generator.particles, img.shape)
+    if annotations == 'records':
+        labels = particle_table(generator.particles, index)
+    elif annotations == 'coco':
+        labels = coco_annotations(generator.particles, img.shape, image_id=index)
+    else:
+        labels = None
+    return(img, mask, labels)
+
+
+class ParticleStream(object):
+    def __init__(self, config, seed=None, count=None, start=0, workers=None, prefetch=PREFETCH,
+            image_type='particle_bkg_image', image_dtype=None, annotations='records'):
+        # iterable of (image, mask, annotations) samples rendered on demand,
+        # count=None streams forever; sample i is always the same for a seed,
+        # start skips the first samples, e.g. to resume a run
+        # workers=0 renders in the consumer's process, otherwise at most
+        # prefetch samples are rendered ahead by a pool of worker processes
+        if image_type not in IMAGE_TYPES:
+            raise ValueError('Unknown image type: ' + str(image_type))
+        if annotations not in STREAM_ANNOTATIONS:
+            raise ValueError('Unknown annotation format: ' + str(annotations))
+        self.config = config
+        self.root = root_seed(seed)
+        self.count = count
+        self.start = start
+        self.workers = workers
+        self.prefetch = max(prefetch, 1)
+        self.image_type = image_type
+        self.image_dtype = image_dtype
+        self.annotations = annotations
+        self.pool = None
+
+    def __len__(self):
+        if self.count is None:
+            raise TypeError('Endless stream has no length')
+        return max(self.count - self.start, 0)
+
+    def job(self, index):
+        return (index, self.config, child_seed(self.root, index), self.image_type,
+            self.image_dtype, self.annotations)
+
+    def indexes(self):
+        index = self.start
+        while self.count is None or index < self.count:
+            yield index
+            index += 1
+
+    def __iter__(self):
+        if self.workers == 0:
+            for index in self.indexes():
+                yield make_sample(self.job(index))
+            return
+
+        # the oldest pending sample is always the next one, so samples come
+        # out in order and no more than prefetch are held at once
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        pending = collections.deque()
+        indexes = self.indexes()
+        try:
+            for index in indexes:
+                pending.append(self.pool.apply_async(make_sample, (self.job(index),)))
+                if len(pending) >= self.prefetch:
+                    break
+            while pending:
+                sample = pending.popleft().get()
+                for index in indexes:
+                    pending.append(self.pool.apply_async(make_sample, (self.job(index),)))
+                    break
+                yield sample
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        # stop the workers, samples still being rendered are dropped
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def stream_samples(config, seed=None, count=None, **kwargs):
+    # generator function form of ParticleStream
+    with ParticleStream(config, seed=seed, count=count, **kwargs) as stream:
+        for sample in stream:
+            yield sample
@@ -0,0 +1,281 @@
+"""Columnar table of the particles of a scene, their masks kept in one pixel pool."""
+import itertools
+
+import numpy as np
+
+from particle_simulation.engine import PARTICLE_SHAPES
+from particle_simulation.manifest import coords_state
+from particle_simulation.store import split_size
+
+# shapes whose coords are drawn at random and have to be kept
+RANDOM_SHAPES = ['Oct-Rand', 'Quadrilateral']
+
+# rows of the first allocation, the capacity doubles when it is full
+CAPACITY = 64
+
+# uids of every table of the process, a scene never mistakes a new particle for an old one
+UIDS = itertools.count()
+
+# one array per column, row i of every array is particle i
+COLUMNS = [
+    ('uid', np.int64),       # never reused: an edited particle gets a new one
+    ('shape', np.int8),      # index in PARTICLE_SHAPES
+    ('size', np.float64),    # size, major axis of ellipses
+    ('minor', np.float64),   # minor axis of ellipses, size otherwise
+    ('noise', np.float64),
+    ('rotation', np.float64),
+    ('coords', np.int64),    # offset of x then y in the coords pool, -1 if not random
+    ('vertices', np.int32),  # number of coords
+    ('mask', np.int64),      # offset of the mask in the pixel pool, -1 without mask
+    ('height', np.int32),    # size of the mask
+    ('width', np.int32),
+    ('placed', bool),        # position and center are those of the last image
+    ('y0', np.int32),        # top left corner of the mask in the image
+    ('x0', np.int32),
+    ('center_y', np.int32),
+    ('center_x', np.int32),
+]
+
+
+def number(value):
+    # int when the float is one, as the widgets give them
+    value = float(value)
+    return(int(value) if value.is_integer() else value)
+
+
+class Pool(object):
+    def __init__(self, dtype):
+        # append only 1d buffer, its capacity doubles when it is full
+        self.data = np.zeros(CAPACITY, dtype=dtype)
+        self.used = 0
+
+    def append(self, values):
+        # offset of values in the pool
+        values = np.ravel(values)
+        if self.used + len(values) > len(self.data):
+            data = np.zeros(max(2*len(self.data), self.used + len(values)), dtype=self.data.dtype)
+            data[:self.used] = self.data[:self.used]
+            self.data = data
+        offset = self.used
+        self.data[offset:offset + len(values)] = values
+        self.used += len(values)
+        return(offset)
+
+    def read(self, offset, count):
+        return self.data[offset:offset + count]
+
+    def compact(self, offsets, counts):
+        # keep only the segments (offsets, counts), returns their new offsets;
+        # segments shared by several rows are kept once
+        unique, inverse = np.unique(offsets, return_inverse=True)
+        first = np.zeros(len(unique), dtype=np.int64)
+        first[inverse] = counts
+        data = np.zeros(max(int(first.sum()), CAPACITY), dtype=self.data.dtype)
+        new = np.zeros(len(unique), dtype=np.int64)
+        used = 0
+        for i, (offset, count) in enumerate(zip(unique, first)):
+            data[used:used + count] = self.data[offset:offset + count]
+            new[i] = used
+            used += count
+        # views handed out before stay valid, they keep the old buffer alive
+        self.data = data
+        self.used = used
+        return(new[inverse])
+
+
+class ParticleTable(object):
+    def __init__(self):
+        self.columns = {name: np.zeros(CAPACITY, dtype=dtype) for name, dtype in COLUMNS}
+        self.count = 0
+        self.pixels = Pool(bool)
+        self.coords = Pool(np.float64)
+
+    def __len__(self):
+        return self.count
+
+    def column(self, name):
+        # view of a column, valid until the table changes
+        return self.columns[name][:self.count]
+
+    def find(self, **values):
+        # rows whose columns equal values, shape is given by name
+        keep = np.ones(self.count, dtype=bool)
+        for name, value in values.items():
+            if name == 'shape':
+                value = PARTICLE_SHAPES.index(value)
+            keep &= self.column(name) == value
+        return np.flatnonzero(keep)
+
+    def grow(self, count):
+        capacity = len(self.columns['uid'])
+        if count <= capacity:
+            return
+        capacity = max(2*capacity, count)
+        for name, column in self.columns.items():
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.count] = column[:self.count]
+            self.columns[name] = grown
+
+    def append(self, particles):
+        # add particles at the end, amortised O(1) per particle; returns their rows
+        start = self.count
+        self.grow(start + len(particles))
+        self.count += len(particles)
+        rows = np.arange(start, self.count)
+        for row, particle in zip(rows, particles):
+            self.write(row, particle)
+        return(rows)
+
+    def replace(self, rows, particle):
+        # every row of rows becomes a new copy of particle, its mask stored once
+        masks = {}
+        for row in rows:
+            self.write(row, particle, masks)
+
+    def write(self, row, particle, masks=None):
+        c = self.columns
+        c['uid'][row] = next(UIDS)
+        c['shape'][row] = PARTICLE_SHAPES.index(particle['shape'])
+        c['size'][row], c['minor'][row] = split_size(particle['size'])
+        c['noise'][row] = particle['noise']
+        c['rotation'][row] = particle['rotation']
+        c['coords'][row], c['vertices'][row] = -1, 0
+        if particle['shape'] in RANDOM_SHAPES:
+            coords = particle['coords']
+            c['coords'][row] = self.coords.append(np.concatenate([coords['x'], coords['y']]))
+            c['vertices'][row] = len(coords['x'])
+        c['mask'][row], c['height'][row], c['width'][row] = -1, 0, 0
+        if 'binary' in particle:
+            # edited particles keep their preview, hold_particle stamps it
+            self.store_mask(row, particle['binary'], masks)
+        c['placed'][row] = False
+
+    def store_mask(self, row, mask, masks=None):
+        # masks maps the id of the masks already stored by the caller to their offset
+        if masks is None:
+            masks = {}
+        if id(mask) not in masks:
+            masks[id(mask)] = self.pixels.append(mask.astype(bool, copy=False))
+        c = self.columns
+        c['mask'][row] = masks[id(mask)]
+        c['height'][row], c['width'][row] = mask.shape
+
+    def delete(self, rows):
+        # remove rows in one pass, the rows after them move up
+        keep = np.ones(self.count, dtype=bool)
+        keep[np.asarray(rows, dtype=int)] = False
+        count = int(keep.sum())
+        for name, column in self.columns.items():
+            column[:count] = column[:self.count][keep]
+        self.count = count
+        self.compact()
+
+    def compact(self):
+        # the pixels no row uses any more go once they are most of the pool
+        masks = self.column('mask')
+        live = masks >= 0
+        sizes = (self.column('height')*self.column('width'))[live]
+        if 2*sizes.sum() < self.pixels.used:
+            masks[live] = self.pixels.compact(masks[live], sizes)
+        coords = self.column('coords')
+        live = coords >= 0
+        sizes = 2*self.column('vertices')[live]
+        if 2*sizes.sum() < self.coords.used:
+            coords[live] = self.coords.compact(coords[live], sizes)
+
+    def mask(self, row):
+        c = self.columns
+        if c['mask'][row] < 0:
+            return None
+        h, w = c['height'][row], c['width'][row]
+        return self.pixels.read(c['mask'][row], h*w).reshape(h, w)
+
+    def size_value(self, row):
+        # size as the widgets give it, 'major;minor' for ellipses
+        c = self.columns
+        if PARTICLE_SHAPES[c['shape'][row]] == 'Ellipse':
+            return '%d;%d' % (c['size'][row], c['minor'][row])
+        return number(c['size'][row])
+
+    def particle(self, generator, row):
+        # particle dict of row, as generator.new_particle makes them, with
+        # the mask, position and center of the last image when it has them
+        c = self.columns
+        shape = PARTICLE_SHAPES[c['shape'][row]]
+        coords = self.row_coords(row)
+        if coords is None:
+            # the other shapes are drawn without randomness
+            coords = generator.generate_shape(shape)
+        particle = generator.make_particle(shape, self.size_value(row), float(c['noise'][row]),
+            number(c['rotation'][row]), coords)
+        particle['uid'] = int(c['uid'][row])
+
+        mask = self.mask(row)
+        if mask is not None:
+            rr, cc = np.nonzero(mask)
+            particle['polygon'] = {'rr': rr, 'cc': cc}
+            particle['binary'] = mask
+        if c['placed'][row]:
+            particle['position'] = {'x': int(c['x0'][row]), 'y': int(c['y0'][row])}
+            particle['center'] = {'x': int(c['center_x'][row]), 'y': int(c['center_y'][row])}
+        return(particle)
+
+    def particles(self, generator, known=None):
+        # particle dicts of every row, known maps uids to dicts already made
+        uids = self.column('uid').tolist()
+        if known is None:
+            known = {}
+        return [known[uid] if uid in known else self.particle(generator, row)
+            for row, uid in enumerate(uids)]
+
+    def set_placement(self, placed):
+        # keep where the rows not placed yet were drawn, placed maps uids to
+        # the particle dicts of the image
+        c = self.columns
+        masks = {}
+        for row in np.flatnonzero(~self.column('placed')):
+            particle = placed.get(int(c['uid'][row]))
+            if particle is None:
+                # added while the image was generated
+                continue
+            self.store_mask(row, particle['binary'], masks)
+            c['y0'][row], c['x0'][row] = particle['position']['y'], particle['position']['x']
+            c['center_y'][row], c['center_x'][row] = particle['center']['y'], particle['center']['x']
+            c['placed'][row] = True
+        self.compact()
+
+    def clear_placement(self):
+        # the particles are about to be placed again
+        self.column('placed')[:] = False
+
+    def row_coords(self, row):
+        # stored coords of a random shape, None for the other shapes
+        c = self.columns
+        if c['coords'][row] < 0:
+            return None
+        xy = self.coords.read(c['coords'][row], 2*c['vertices'][row])
+        return {'x': xy[:c['vertices'][row]].copy(), 'y': xy[c['vertices'][row]:].copy()}
+
+    def specs(self):
+        # generator specs of the rows, random shapes keep their coords;
+        # runs of identical particles share one spec
+        rows = np.arange(self.count)
+        if self.count == 0:
+            return []
+        same = np.ones(self.count - 1, dtype=bool)
+        for name in ['shape', 'size', 'minor', 'noise', 'rotation', 'coords']:
+            column = self.column(name)
+            same &= column[1:] == column[:-1]
+        starts = np.concatenate([[0], np.flatnonzero(~same) + 1])
+        amounts = np.diff(np.concatenate([starts, [self.count]]))
+        c = self.columns
+        specs = []
+        for row, amount in zip(rows[starts], amounts):
+            spec = {'shape': PARTICLE_SHAPES[c['shape'][row]], 'size': self.size_value(row),
+                'noise': float(c['noise'][row]), 'rotation': number(c['rotation'][row]),
+                'amount': int(amount)}
+            coords = self.row_coords(row)
+            if coords is not None:
+                spec['coords'] = coords_state(coords)
+            specs.append(spec)
+        return(specs)
@@ -0,0 +1,72 @@
+"""LRU library of ready to stamp particle masks."""
+import collections
+import os
+import threading
+
+
+def template_nbytes(template):
+    return sum(value.nbytes for value in template.values() if hasattr(value, 'nbytes'))
+
+
+class TemplateLibrary(object):
+    def __init__(self, max_bytes=64*2**20):
+        # least recently used templates are dropped above max_bytes
+        self.max_bytes = max_bytes
+        self.templates = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # the library is shared with the generation and preview threads
+        self.lock = threading.RLock()
+
+    def get(self, key, build):
+        # template for key, build() is only called on a miss
+        with self.lock:
+            if key in self.templates:
+                self.templates.move_to_end(key)
+                self.hits += 1
+                return self.templates[key]
+
+            template = build()
+            for value in template.values():
+                if hasattr(value, 'flags'):
+                    value.flags.writeable = False
+            self.misses += 1
+            self.templates[key] = template
+            self.nbytes += template_nbytes(template)
+
+            # always keep the template just built
+            while self.nbytes > self.max_bytes and len(self.templates) > 1:
+                old_key, old = self.templates.popitem(last=False)
+                self.nbytes -= template_nbytes(old)
+                self.evictions += 1
+            return template
+
+    def stats(self):
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            'size': len(self.templates), 'nbytes': self.nbytes,
+            'hit_rate': self.hits/calls if calls else 0.0}
+
+    def clear(self):
+        with self.lock:
+            self.templates = collections.OrderedDict()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def reset_lock(self):
+        # a forked worker process may copy the lock while another thread holds it
+        self.lock = threading.RLock()
+
+
+# shared by every generator of the process
+TEMPLATES = TemplateLibrary()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=TEMPLATES.reset_lock)
+
+
+def template_stats():
+    return TEMPLATES.stats()
@@ -0,0 +1,233 @@
+"""Tile by tile rendering of frames too large to hold in memory."""
+import os
+
+import numpy as np
+
+from particle_simulation.engine import ATTACH_MARGIN, NOISE_PADDING, TILE_PAD, ParticleGenerator, \
+    background_noise
+from particle_simulation.occupancy import OccupancyGrid
+
+TILE = 1024
+
+# the gaussian filter of skimage reads up to 4 sigma away
+GAUSSIAN_TRUNCATE = 4.0
+
+# dtype of the files written for every image type
+TILED_DTYPES = {'binary_image': np.uint8, 'bkg_image': np.float32,
+    'particle_bkg_image': np.float32}
+
+
+def tile_ranges(size, tile):
+    return [(i, min(i + tile, size)) for i in range(0, size, tile)]
+
+
+class TiledRenderer(object):
+    def __init__(self, config=None, tile=TILE, seed=None, on_no_rules=None, on_progress=None):
+        # the particles are placed tile by tile on a local image holding the
+        # tile and a halo, so that no array has the size of the frame
+        self.generator = ParticleGenerator(config, on_no_rules=on_no_rules,
+            seed=seed, on_progress=on_progress)
+        self.config = self.generator.config
+        self.tile = tile
+
+        # the background noise of tile (ty, tx) is drawn from its own seed,
+        # so that a tile and the halos of its neighbours see the same noise
+        self.noise_seed = self.generator.rng.generator.integers(2**63)
+
+        # placed particles: top left corner in the frame and mask
+        self.y0 = np.zeros(0, dtype=int)
+        self.x0 = np.zeros(0, dtype=int)
+        self.y1 = np.zeros(0, dtype=int)
+        self.x1 = np.zeros(0, dtype=int)
+        self.masks = []
+
+    def particle_extent(self):
+        # largest distance from a particle center to its mask, noise included
+        extent = 0
+        for particle in self.generator.particles:
+            template = self.generator.particle_template(particle)
+            half = max(max(template['rr']), max(template['cc']))/2
+            extent = max(extent, int(NOISE_PADDING*half) + TILE_PAD + 1,
+                max(template['mask'].shape))
+        return(extent)
+
+    def assign_tiles(self):
+        # tile of every particle, drawn with the density of the centers
+        # allowed by the edge rule
+        w = self.config['width']
+        h = self.config['height']
+        tiles = {}
+        for particle in self.generator.particles:
+            template = self.generator.particle_template(particle)
+            half_x = int(max(template['cc'])/2)
+            half_y = int(max(template['rr'])/2)
+            y_lo, y_hi, x_lo, x_hi = self.generator.center_bounds(half_x, half_y, h, w)
+            y = int(self.generator.rand(y_lo, y_hi))
+            x = int(self.generator.rand(x_lo, x_hi))
+            tiles.setdefault((y//self.tile, x//self.tile), []).append(particle)
+        return(tiles)
+
+    def stamp(self, occupancy, oy, ox):
+        # draw the particles already placed on the local occupancy image
+        h, w = occupancy.img.shape
+        near = (self.y1 > oy) & (self.y0 < oy + h) & (self.x1 > ox) & (self.x0 < ox + w)
+        for i in np.nonzero(near)[0]:
+            occupancy.add(self.masks[i], self.y0[i] - oy, self.x0[i] - ox)
+
+    def place(self):
+        # place every particle, the frame is walked tile by tile
+        generator = self.generator
+        w = self.config['width']
+        h = self.config['height']
+        halo = self.particle_extent() + ATTACH_MARGIN
+        tiles = self.assign_tiles()
+        generator.retries = 0
+        placed = 0
+        total = len(generator.particles)
+
+        for ty, (cy0, cy1) in enumerate(tile_ranges(h, self.tile)):
+            for tx, (cx0, cx1) in enumerate(tile_ranges(w, self.tile)):
+                particles = tiles.get((ty, tx), [])
+                if len(particles) == 0:
+                    continue
+                oy, ox = max(cy0 - halo, 0), max(cx0 - halo, 0)
+                img = np.zeros([min(cy1 + halo, h) - oy, min(cx1 + halo, w) - ox], dtype=bool)
+                generator.occupancy = OccupancyGrid(img, margin=ATTACH_MARGIN)
+                self.stamp(generator.occupancy, oy, ox)
+                generator.window = {'y': oy, 'x': ox, 'height': h, 'width': w,
+                    'core': (cy0, cy1, cx0, cx1)}
+                try:
+                    generator.place_particles(particles, img, placed, total)
+                finally:
+                    generator.window = None
+                    generator.occupancy = None
+                placed += len(particles)
+
+                # positions are kept in frame coordinates
+                for particle in particles:
+                    particle['center'] = {'x': particle['center']['x'] + ox,
+                        'y': particle['center']['y'] + oy}
+                    particle['position'] = {'x': particle['position']['x'] + ox,
+                        'y': particle['position']['y'] + oy}
+                self.add_placed(particles)
+
+    def add_placed(self, particles):
+        y0 = np.array([p['position']['y'] for p in particles], dtype=int)
+        x0 = np.array([p['position']['x'] for p in particles], dtype=int)
+        self.y0 = np.concatenate([self.y0, y0])
+        self.x0 = np.concatenate([self.x0, x0])
+        self.y1 = np.concatenate([self.y1, y0 + [p['binary'].shape[0] for p in particles]])
+        self.x1 = np.concatenate([self.x1, x0 + [p['binary'].shape[1] for p in particles]])
+        self.masks += [p['binary'] for p in particles]
+
+    def binary_window(self, y0, y1, x0, x1):
+        img = np.zeros([y1 - y0, x1 - x0], dtype=bool)
+        near = (self.y1 > y0) & (self.y0 < y1) & (self.x1 > x0) & (self.x0 < x1)
+        for i in np.nonzero(near)[0]:
+            rows = slice(max(self.y0[i], y0), min(self.y1[i], y1))
+            cols = slice(max(self.x0[i], x0), min(self.x1[i], x1))
+            mask = self.masks[i][rows.start - self.y0[i]:rows.stop - self.y0[i],
+                cols.start - self.x0[i]:cols.stop - self.x0[i]]
+            img[rows.start - y0:rows.stop - y0, cols.start - x0:cols.stop - x0] |= mask
+        return(img)
+
+    def noise_block(self, ty, tx):
+        # background noise of the core of tile (ty, tx), same as generate_images
+        w = self.config['width']
+        h = self.config['height']
+        cy0, cy1 = tile_ranges(h, self.tile)[ty]
+        cx0, cx1 = tile_ranges(w, self.tile)[tx]
+        rng = np.random.default_rng([self.noise_seed, ty, tx])
+        return background_noise(rng, [cy1 - cy0, cx1 - cx0], self.config['background'],
+            self.config['dtype'])
+
+    def bkg_window(self, y0, y1, x0, x1):
+        # background noise of a window assembled from the tile blocks it covers
+        bkg = np.zeros([y1 - y0, x1 - x0], dtype=self.config['dtype'])
+        if self.config['background'] <= 0:
+            return(bkg)
+        t = self.tile
+        for ty in range(y0//t, (y1 - 1)//t + 1):
+            for tx in range(x0//t, (x1 - 1)//t + 1):
+                block = self.noise_block(ty, tx)
+                rows = slice(max(ty*t, y0), min(ty*t + block.shape[0], y1))
+                cols = slice(max(tx*t, x0), min(tx*t + block.shape[1], x1))
+                bkg[rows.start - y0:rows.stop - y0, cols.start - x0:cols.stop - x0] = \
+                    block[rows.start - ty*t:rows.stop - ty*t, cols.start - tx*t:cols.stop - tx*t]
+        return(bkg)
+
+    def render_halo(self):
+        # pixels around a tile that reach it through the shadow and the blur
+        halo = int(np.ceil(GAUSSIAN_TRUNCATE*self.config['gaussian'])) + 1
+        if self.config['shadow'] != 0:
+            halo += self.generator.shadow_radius()
+        return(halo)
+
+    def render_tiles(self):
+        # (y0, x0, images) for every tile of the frame, the images
+        # only hold the tile, not its halo
+        w = self.config['width']
+        h = self.config['height']
+        halo = self.render_halo()
+        for ty, (cy0, cy1) in enumerate(tile_ranges(h, self.tile)):
+            for tx, (cx0, cx1) in enumerate(tile_ranges(w, self.tile)):
+                y0, y1 = max(cy0 - halo, 0), min(cy1 + halo, h)
+                x0, x1 = max(cx0 - halo, 0), min(cx1 + halo, w)
+                binary = self.binary_window(y0, y1, x0, x1)
+                bkg = self.bkg_window(y0, y1, x0, x1)
+                particle_bkg = self.generator.render(binary, bkg)
+                core = (slice(cy0 - y0, cy1 - y0), slice(cx0 - x0, cx1 - x0))
+                yield cy0, cx0, {'binary_image': binary[core], 'bkg_image': bkg[core],
+                    'particle_bkg_image': particle_bkg[core]}
+
+    def save(self, out_dir, image_types=None, prefix='image', callback=None):
+        # place the particles and write the frame tile by tile in .npy files
+        # that can be opened with np.load(file_name, mmap_mode='r')
+        # callback(done, count) is called after every tile
+        if image_types is None:
+            image_types = list(TILED_DTYPES)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        try:
+            return self.write_tiles(out_dir, image_types, prefix, callback)
+        finally:
+            self.generator.end_run()
+
+    def write_tiles(self, out_dir, image_types, prefix, callback):
+        w = self.config['width']
+        h = self.config['height']
+        self.place()
+        outputs = {}
+        for image_type in image_types:
+            file_name = os.path.join(out_dir, prefix + '_' + image_type + '.npy')
+            outputs[image_type] = np.lib.format.open_memmap(file_name, mode='w+',
+                dtype=TILED_DTYPES[image_type], shape=(h, w))
+
+        count = len(tile_ranges(h, self.tile))*len(tile_ranges(w, self.tile))
+        done = 0
+        for y0, x0, images in self.render_tiles():
+            for image_type in image_types:
+                img = images[image_type]
+                outputs[image_type][y0:y0 + img.shape[0], x0:x0 + img.shape[1]] = img
+            done += 1
+            if callback is not None:
+                callback(done, count)
+
+        file_names = {}
+        for image_type in image_types:
+            outputs[image_type].flush()
+            file_names[image_type] = outputs[image_type].filename
+        del outputs
+        return(file_names)
+
+    def cancel(self):
+        self.generator.cancel()
+
+    def cancel_token(self):
+        return self.generator.cancel_token()
+
+
+def render_tiled(config, out_dir, tile=TILE, seed=None, image_types=None,
+        prefix='image', callback=None):
+    renderer = TiledRenderer(config, tile=tile, seed=seed)
+    return renderer.save(out_dir, image_types=image_types, prefix=prefix, callback=callback)
@@ -0,0 +1,97 @@
+"""Cached, tiled and replayed images against the images rendered from scratch."""
+import os
+
+import imageio.v2 as imgio
+import numpy as np
+
+from particle_simulation import ParticleGenerator, Scene, TiledRenderer, generate_dataset, replay
+from particle_simulation.convert import to_uint8
+from particle_simulation.manifest import load_manifest, scene_manifest
+
+IMAGE_TYPES = ['binary_image', 'bkg_image', 'particle_bkg_image']
+
+CONFIG = {'width': 160, 'height': 120, 'background': 0.2, 'contrast': 0.5, 'shadow': 0.4,
+    'gaussian': 1.0, 'not_attach': True,
+    'particles': [{'shape': 'Circle', 'size': 6, 'noise': 0.1, 'rotation': 0, 'amount': 12},
+        {'shape': 'Ellipse', 'size': '9;5', 'noise': 0, 'rotation': 30, 'amount': 6}]}
+
+
+def make_particles(seed=2, config=CONFIG):
+    return ParticleGenerator(config, seed=seed).particles
+
+
+def full_render(scene):
+    # the layers of the scene rendered again on the whole frame
+    scene.render_layers(0, [])
+    return(scene.images())
+
+
+def copy_images(images):
+    # the scene updates its images in place
+    return {image_type: images[image_type].copy() for image_type in IMAGE_TYPES}
+
+
+def assert_same_images(images, expected):
+    for image_type in IMAGE_TYPES:
+        np.testing.assert_array_equal(images[image_type], expected[image_type], err_msg=image_type)
+
+
+def test_config_update_matches_new_scene():
+    scene = Scene(CONFIG, seed=1)
+    scene.generate_images(make_particles())
+    for key, value in [('contrast', 0.7), ('gaussian', 2.0), ('shadow', 0.2), ('background', 0.4)]:
+        config = dict(scene.config, **{key: value})
+        scene.configure(config)
+        images = scene.generate_images(scene.particles)
+        expected = Scene(config, seed=1).generate_images(make_particles())
+        assert_same_images(images, expected)
+
+
+def test_particle_update_matches_full_render():
+    scene = Scene(CONFIG, seed=1)
+    particles = make_particles()
+    scene.generate_images(particles)
+    # remove some particles and place new ones among those left
+    kept = particles[:5] + particles[8:]
+    images = copy_images(scene.generate_images(kept))
+    assert_same_images(images, full_render(scene))
+    images = copy_images(scene.generate_images(kept + make_particles(seed=3)[:4]))
+    assert_same_images(images, full_render(scene))
+    assert not scene.replayable
+
+
+def test_tiled_matches_monolithic_render():
+    renderer = TiledRenderer(CONFIG, tile=48, seed=1)
+    renderer.place()
+    h, w = CONFIG['height'], CONFIG['width']
+    tiled = {image_type: np.zeros((h, w)) for image_type in IMAGE_TYPES}
+    for y0, x0, images in renderer.render_tiles():
+        for image_type in IMAGE_TYPES:
+            img = images[image_type]
+            tiled[image_type][y0:y0 + img.shape[0], x0:x0 + img.shape[1]] = img
+
+    # the same particles and background rendered as one frame
+    binary = renderer.binary_window(0, h, 0, w)
+    bkg = renderer.bkg_window(0, h, 0, w)
+    np.testing.assert_array_equal(tiled['binary_image'], binary)
+    np.testing.assert_array_equal(tiled['bkg_image'], bkg)
+    np.testing.assert_allclose(tiled['particle_bkg_image'], renderer.generator.render(binary, bkg),
+        atol=1e-6)
+
+
+def test_scene_manifest_replay():
+    scene = Scene(CONFIG, seed=1)
+    images = scene.generate_images(make_particles())
+    assert scene.replayable
+    manifest = scene_manifest(scene.config, scene.seed, scene.particles)
+    assert_same_images(replay(manifest), images)
+
+
+def test_dataset_manifest_replay(tmp_path):
+    start = 2
+    files = generate_dataset(CONFIG, 3, str(tmp_path), workers=1, seed=4, start=start)
+    manifest = load_manifest(os.path.join(str(tmp_path), 'image_manifest.json'))
+    for i, file_name in enumerate(files):
+        assert file_name.endswith('image_' + str(start + i + 1) + '.png')
+        images = replay(manifest, start + i)
+        np.testing.assert_array_equal(to_uint8(images['particle_bkg_image']), imgio.imread(file_name))